@@ -1,23 +1,139 @@
 #!/usr/bin/env python3
 
-from botocore.exceptions import ClientError
-from datetime import date
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from datetime import date, datetime
 
 import argparse
 import boto3
 import csv
+import hashlib
 import io
+import itertools
+import json
+import mimetypes
+import multiprocessing
 
 import ntpath
 import os
+import shutil
+import sqlite3
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 
-s3 = boto3.client('s3')
+DEFAULT_WORKERS = 8
+
+def peak_rss_mb():
+   # peak resident memory of the process in MB, None where the resource module is missing (Windows)
+   # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+   try:
+      import resource
+   except ImportError:
+      return None
+   rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+def create_client(workers = DEFAULT_WORKERS):
+   # boto3 clients are thread safe: one client is shared by every upload thread,
+   # with a connection pool large enough for all of them
+   return boto3.client('s3', config=Config(max_pool_connections=max(workers, 10)))
+
+s3 = create_client()
+
+# multipart settings are explicit so the ETag of an uploaded file can be computed locally
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_CHUNKSIZE, multipart_chunksize=MULTIPART_CHUNKSIZE)
+
+COMPRESSION_SUFFIXES = {
+   'gzip': '.gz',
+   'zstd': '.zst'
+}
+
+# columns of the post exports that are numbers or dates, the others (ids, names, labels) are kept as text in Parquet
+NUMERIC_COLUMNS = ['date', 'mentions', 'total_engagements', 'video_views', 'reach_for_eng', 'reach_for_vv', 'audience_size']
+
+mimetypes.add_type('application/x-ndjson', '.ndjson')
+mimetypes.add_type('application/vnd.apache.parquet', '.parquet')
+mimetypes.encodings_map['.zst'] = 'zstd'
+
+def content_args(key, compressed = False):
+   # content type of the object from its name, and content encoding when this script compressed it (data.csv.gz: text/csv, gzip);
+   # a file that was already compressed is not given one, clients would decompress it on download
+   content_type, content_encoding = mimetypes.guess_type(key)
+   extra_args = { 'ContentType': content_type or 'binary/octet-stream' }
+   if compressed and content_encoding:
+      extra_args['ContentEncoding'] = content_encoding
+   return extra_args
+
+def compressor(compression):
+   if compression == 'gzip':
+      return zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+   if compression == 'zstd':
+      import zstandard
+      return zstandard.ZstdCompressor().compressobj()
+   return None
+
+def transformed_name(filename, compression = None, to_parquet = False):
+   # name of the object uploaded for a file, None when the file is uploaded as it is
+   if to_parquet and filename.lower().endswith('.csv'):
+      return filename[:-len('.csv')] + '.parquet'
+   if compression:
+      return filename + COMPRESSION_SUFFIXES[compression]
+   return None
+
+def transform_file(file, directory, name, compression = None, to_parquet = False):
+   # runs in the transform processes: writes the compressed or Parquet copy of file to directory
+   start = time.perf_counter()
+   target = os.path.join(directory, f'{uuid.uuid4().hex}-{name}')
+
+   if name.endswith('.parquet'):
+      import pyarrow
+      import pyarrow.csv
+      import pyarrow.parquet
+
+      # CSV -> Parquet by blocks, columns compressed with the chosen codec
+      codec = compression or 'snappy'
+      read_options = pyarrow.csv.ReadOptions(block_size=64 * 1024 * 1024)
+      with open(file, newline='', encoding='utf-8') as f:
+         columns = next(csv.reader(f), [])
+
+      def convert(text_columns):
+         convert_options = pyarrow.csv.ConvertOptions(column_types={ column: pyarrow.string() for column in text_columns })
+         reader = pyarrow.csv.open_csv(file, read_options=read_options, convert_options=convert_options)
+         with pyarrow.parquet.ParquetWriter(target, reader.schema, compression=codec) as writer:
+            for batch in reader:
+               writer.write_batch(batch)
+
+      try:
+         # ids are not inferred as numbers: uids like 007 and 7 would become the same value
+         convert([column for column in columns if column not in NUMERIC_COLUMNS])
+      except pyarrow.ArrowInvalid:
+         # types inferred from the first block don't fit the rest of the file: keep every column as text
+         convert(columns)
+   else:
+      stream = compressor(compression)
+      with open(file, 'rb') as source, open(target, 'wb') as destination:
+         for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            destination.write(stream.compress(chunk))
+         destination.write(stream.flush())
+
+   return { 'name': name, 'file': target, 'transform_s': time.perf_counter() - start }
 
 METADATA_HEADERS = [
    'Path',
    'File',
-   'Date'
+   'Date',
+   'Size',
+   'Stored Size'
 ]
 
 class S3File(object):
@@ -42,17 +158,347 @@ class S3File(object):
         self.buffer.close()
         print(f"Wrote record to [{self.bucket}]/{self.path}")
 
-def get_filepaths(directory):
-    file_paths = []
+class UploadProfile(object):
+    # --profile: bytes, upload latency and throughput of each file of the run, and of the whole run
+    COLUMNS = ['local', 'key', 'status', 'size', 'stored_size', 'transform_s', 'upload_s', 'mb_per_s']
+
+    def __init__(self):
+        super().__init__()
+        self.start = time.perf_counter()
+        self.files = []
+
+    def add(self, result):
+        if 'error' in result:
+            status = 'failed'
+        else:
+            status = 'skipped' if result['skipped'] else 'uploaded'
+        upload_s = result.get('upload_s')
+        stored_size = result.get('stored_size')
+        self.files.append({
+            'local': result['local'],
+            'key': f"{result['path'].rstrip('/')}/{result['file']}" if 'path' in result else None,
+            'status': status,
+            'size': result.get('size'),
+            'stored_size': stored_size,
+            'transform_s': result.get('transform_s'),
+            'upload_s': upload_s,
+            'mb_per_s': stored_size / upload_s / 1024 / 1024 if status == 'uploaded' and stored_size and upload_s else None
+        })
+
+    def summary(self):
+        wall = time.perf_counter() - self.start
+        uploaded = [file for file in self.files if file['status'] == 'uploaded']
+        latencies = sorted(file['upload_s'] for file in uploaded)
+        stored_bytes = sum(file['stored_size'] or 0 for file in uploaded)
+        percentile = lambda q: latencies[min(int(q * len(latencies)), len(latencies) - 1)] if latencies else None
+        return {
+            'files': len(self.files),
+            'uploaded': len(uploaded),
+            'skipped': sum(file['status'] == 'skipped' for file in self.files),
+            'failed': sum(file['status'] == 'failed' for file in self.files),
+            'bytes': sum(file['size'] or 0 for file in uploaded),
+            'stored_bytes': stored_bytes,
+            'wall_s': wall,
+            'cpu_s': time.process_time(),
+            'files_per_s': len(uploaded) / wall if wall else None,
+            'mb_per_s': stored_bytes / wall / 1024 / 1024 if wall else None,
+            'transform_s': sum(file['transform_s'] or 0 for file in self.files),
+            'upload_s': sum(latencies),
+            'upload_p50_s': percentile(0.5),
+            'upload_p95_s': percentile(0.95),
+            'upload_max_s': latencies[-1] if latencies else None,
+            'peak_rss_mb': peak_rss_mb()
+        }
+
+    def write(self, path):
+        summary = self.summary()
+        if path == '-':
+            for name, value in summary.items():
+                print(f'{name:>14}  {value:.3f}' if isinstance(value, float) else f'{name:>14}  {value}')
+        elif path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump({ 'summary': summary, 'files': self.files }, f, indent=2)
+        else:
+            # one row by file, the summary is printed
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, self.COLUMNS)
+                writer.writeheader()
+                writer.writerows(self.files)
+            print(f"Uploaded {summary['uploaded']} files ({summary['stored_bytes']} bytes) in {summary['wall_s']:.3f}s")
+
+class UploadJournal(object):
+    # SQLite file recording the files uploaded by a run and the parts of its multipart uploads,
+    # so an interrupted run can be resumed; shared by the upload threads
+    def __init__(self, path):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (bucket TEXT, key TEXT, local TEXT, size INTEGER, mtime REAL, upload_id TEXT, completed INTEGER, PRIMARY KEY (bucket, key))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS parts (bucket TEXT, key TEXT, part_number INTEGER, etag TEXT, PRIMARY KEY (bucket, key, part_number))')
+
+    def execute(self, query, parameters = ()):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def is_completed(self, bucket, key, size, mtime):
+        return bool(self.execute('SELECT 1 FROM files WHERE bucket = ? AND key = ? AND size = ? AND mtime = ? AND completed = 1', (bucket, key, size, mtime)))
+
+    def get_upload(self, bucket, key, size, mtime):
+        rows = self.execute('SELECT upload_id FROM files WHERE bucket = ? AND key = ? AND size = ? AND mtime = ? AND completed = 0', (bucket, key, size, mtime))
+        if not rows:
+            return None
+        parts = self.execute('SELECT part_number, etag FROM parts WHERE bucket = ? AND key = ?', (bucket, key))
+        return rows[0][0], dict(parts)
+
+    def start_upload(self, bucket, key, local, size, mtime, upload_id):
+        self.forget(bucket, key)
+        self.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, 0)', (bucket, key, local, size, mtime, upload_id))
+
+    def add_part(self, bucket, key, part_number, etag):
+        self.execute('INSERT OR REPLACE INTO parts VALUES (?, ?, ?, ?)', (bucket, key, part_number, etag))
+
+    def complete(self, bucket, key, local, size, mtime):
+        self.forget(bucket, key)
+        self.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, NULL, 1)', (bucket, key, local, size, mtime))
+
+    def forget(self, bucket, key):
+        self.execute('DELETE FROM parts WHERE bucket = ? AND key = ?', (bucket, key))
+        self.execute('DELETE FROM files WHERE bucket = ? AND key = ?', (bucket, key))
 
-    for root, directories, files in os.walk(directory):
-        for filename in files:
-            filepath = os.path.join(root, filename)
-            file_paths.append(filepath)
+    def pending_uploads(self):
+        return self.execute('SELECT bucket, key, upload_id FROM files WHERE completed = 0')
 
-    return file_paths
+    def reset(self):
+        self.execute('DELETE FROM parts')
+        self.execute('DELETE FROM files')
+
+    def close(self):
+        self.connection.close()
+
+class ManifestPart(object):
+    # metadata rows of one run, written as their own object under the monthly metadata prefix:
+    # runs don't read or rewrite the rows of the others
+    def __init__(self, bucket, prefix):
+        super().__init__()
+        self.bucket = bucket
+        self.path = f"{prefix}/part-{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.csv"
+
+    def __enter__(self):
+        self.buffer = io.BytesIO()
+        return io.TextIOWrapper(self.buffer, encoding='utf-8', write_through=True)
+
+    def __exit__(self, type, value, traceback):
+        if self.buffer.tell():
+            self.buffer.seek(0)
+            s3.upload_fileobj(self.buffer, self.bucket, self.path)
+            print(f"Wrote record to [{self.bucket}]/{self.path}")
+        self.buffer.close()
+
+def metadata_rows(body):
+    rows = list(csv.reader(io.StringIO(body)))
+    if rows and rows[0][0] == METADATA_HEADERS[0]:
+        rows = rows[1:]
+    # files written before the size columns were added
+    return [row + [''] * (len(METADATA_HEADERS) - len(row)) for row in rows]
+
+def read_csv_object(bucket, key):
+    return metadata_rows(s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+
+def compact_metadata(bucket, prefix, metadata_format = 'csv'):
+    # merge the run parts of a month into metadata-{year}-{month}.csv (or .parquet) and delete them
+    parts = sorted(list_objects(bucket, prefix + '/'))
+    if not parts:
+        print(f"No metadata parts to compact in [{bucket}]/{prefix}/")
+        return
+
+    rows = [row for key in parts for row in read_csv_object(bucket, key)]
+
+    if metadata_format == 'csv':
+        with S3File(bucket, f'{prefix}.csv') as buf:
+            writer = csv.writer(buf)
+            if buf.tell() != 0:
+                buf.seek(0)
+                body = buf.read()
+                if next(csv.reader(io.StringIO(body)), []) != METADATA_HEADERS:
+                    # monthly file written with older headers: rewritten with the current ones before appending
+                    existing = metadata_rows(body)
+                    buf.seek(0)
+                    buf.truncate()
+                    writer.writerow(METADATA_HEADERS)
+                    writer.writerows(existing)
+            if buf.tell() == 0:
+                writer.writerow(METADATA_HEADERS)
+            writer.writerows(rows)
+    else:
+        try:
+            import pandas as pd
+            import pyarrow
+        except ImportError:
+            sys.exit('Compacting the metadata to Parquet needs pandas and pyarrow: pip install pandas pyarrow')
+
+        frame = pd.DataFrame(rows, columns=METADATA_HEADERS)
+        try:
+            existing = s3.get_object(Bucket=bucket, Key=f'{prefix}.parquet')['Body'].read()
+        except ClientError:
+            print(f"File [{bucket}]/{prefix}.parquet was not found")
+        else:
+            frame = pd.concat([pd.read_parquet(io.BytesIO(existing)), frame], ignore_index=True)
+        buffer = io.BytesIO()
+        frame.to_parquet(buffer, index=False)
+        buffer.seek(0)
+        s3.upload_fileobj(buffer, bucket, f'{prefix}.parquet')
+        print(f"Wrote record to [{bucket}]/{prefix}.parquet")
+
+    # only the parts merged above are deleted, parts written meanwhile are kept for the next compaction
+    for start in range(0, len(parts), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={ 'Objects': [{ 'Key': key } for key in parts[start:start + 1000]], 'Quiet': True })
+    print(f"Compacted {len(parts)} metadata parts ({len(rows)} rows)")
+
+class S3Writer(io.RawIOBase):
+    # writable file-like object uploading what is written to bucket/key as a multipart upload:
+    # at most max_pending parts are kept in memory while they upload, and data can be compressed on the fly
+    def __init__(self, bucket, key, compression = None, part_size = MULTIPART_CHUNKSIZE, max_pending = 2):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_pending = max_pending
+        self.compressor = compressor(compression)
+        self.extra_args = content_args(key, compression is not None)
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.executor = None
+        self.parts = []
+        self.size = 0
+        self.stored_size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        self.buffer += self.compressor.compress(data) if self.compressor else data
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra_args)['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=self.max_pending)
+
+        pending = [part for part in self.parts if not part.done()]
+        if len(pending) >= self.max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for part in done:
+                part.result()
+
+        self.parts.append(self.executor.submit(s3.upload_part, Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=len(self.parts) + 1, Body=body))
+        self.stored_size += len(body)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.compressor:
+                self.buffer += self.compressor.flush()
+            if self.upload_id is None:
+                s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self.extra_args)
+                self.stored_size = len(self.buffer)
+            else:
+                if self.buffer:
+                    self.upload_part(bytes(self.buffer))
+                parts = [{ 'PartNumber': number, 'ETag': part.result()['ETag'] } for number, part in enumerate(self.parts, 1)]
+                s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={ 'Parts': parts })
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self.buffer = bytearray()
+            if self.executor is not None:
+                self.executor.shutdown()
+            super().close()
 
-def upload_file(bucket, file, base_path = '', ignore_file_parent_folder = False, ignore_main_local_folder = False):
+    def abort(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.upload_id is not None:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        self.buffer = bytearray()
+        super().close()
+
+    def __exit__(self, type, value, traceback):
+        # nothing is written to the bucket when the block fails
+        if type is not None:
+            self.abort()
+        else:
+            self.close()
+
+def upload_stream(stream, bucket, key, compression = None):
+   # upload a readable binary file-like object (a file, a pipe, sys.stdin.buffer...) without writing it to disk
+   with S3Writer(bucket, key, compression) as writer:
+      shutil.copyfileobj(stream, writer, 1024 * 1024)
+
+   return { 'key': key, 'size': writer.size, 'stored_size': writer.stored_size }
+
+def walk_files(directory):
+    # same files and order as os.walk, yielded with their stat while the folders are read
+    subdirectories = []
+
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirectories.append(entry.path)
+                continue
+            try:
+                yield entry.path, entry.stat()
+            except OSError:
+                continue
+
+    for subdirectory in subdirectories:
+        yield from walk_files(subdirectory)
+
+def list_objects(bucket, prefix = ''):
+   objects = {}
+
+   paginator = s3.get_paginator('list_objects_v2')
+   for page in paginator.paginate(Bucket=bucket, Prefix=prefix or ''):
+      for obj in page.get('Contents', []):
+         objects[obj['Key']] = { 'size': obj['Size'], 'etag': obj['ETag'].strip('"') }
+
+   return objects
+
+def local_etag(file, size):
+   # S3 ETag: MD5 of the file, or MD5 of the part MD5s followed by the number of parts for multipart uploads
+   if size < MULTIPART_CHUNKSIZE:
+      md5 = hashlib.md5()
+      with open(file, 'rb') as f:
+         for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+      return md5.hexdigest()
+
+   digests = []
+   with open(file, 'rb') as f:
+      for chunk in iter(lambda: f.read(MULTIPART_CHUNKSIZE), b''):
+         digests.append(hashlib.md5(chunk).digest())
+   return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
+
+def is_unchanged(file, size, obj):
+   if obj is None or obj['size'] != size:
+      return False
+
+   return local_etag(file, size) == obj['etag']
+
+def get_key(file, base_path = '', ignore_file_parent_folder = False, ignore_main_local_folder = False):
    path, filename = ntpath.split(file)
 
    if ignore_file_parent_folder:
@@ -66,22 +512,172 @@ def upload_file(bucket, file, base_path = '', ignore_file_parent_folder = False,
    
    path_in_bucket = base_path + path  
    filename_in_bucket = path_in_bucket + "/" + filename if (path_in_bucket[-1] != "/") else path_in_bucket + filename
-   s3 = boto3.client('s3')
+
+   return path_in_bucket, filename, filename_in_bucket
+
+def multipart_upload(bucket, file, key, size, mtime, journal, source = None, extra_args = None, retry = True):
+   # parts are recorded in the journal as they are uploaded, a resumed run only sends the missing ones;
+   # source is the file sent when it is a transformed copy of file
+   source = source or file
+   upload = journal.get_upload(bucket, key, size, mtime)
+   if upload:
+      upload_id, parts = upload
+      print(f'Resuming upload of file {file} ({len(parts)} parts already uploaded)...')
+   else:
+      upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **(extra_args or {}))['UploadId']
+      parts = {}
+      journal.start_upload(bucket, key, file, size, mtime, upload_id)
+
+   try:
+      with open(source, 'rb') as f:
+         for part_number, offset in enumerate(range(0, os.fstat(f.fileno()).st_size, MULTIPART_CHUNKSIZE), 1):
+            if part_number in parts:
+               continue
+            f.seek(offset)
+            response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=f.read(MULTIPART_CHUNKSIZE))
+            parts[part_number] = response['ETag']
+            journal.add_part(bucket, key, part_number, response['ETag'])
+
+      s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+         MultipartUpload={ 'Parts': [{ 'PartNumber': part_number, 'ETag': parts[part_number] } for part_number in sorted(parts)] })
+   except ClientError as error:
+      # the multipart upload expired or was aborted since it was recorded: start it over
+      if retry and upload and error.response['Error']['Code'] == 'NoSuchUpload':
+         journal.forget(bucket, key)
+         return multipart_upload(bucket, file, key, size, mtime, journal, source, extra_args, retry=False)
+      raise
+
+def send_file(bucket, file, key, stat, journal = None, source = None):
+   # files sent as they are are stored as they always were, the compressed or converted copies get their content type and encoding
+   extra_args = content_args(key, compressed=True) if source and source != file else {}
+   source = source or file
+
+   if journal is None:
+      s3.upload_file(source, bucket, key, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
+   else:
+      if os.path.getsize(source) >= MULTIPART_CHUNKSIZE:
+         multipart_upload(bucket, file, key, stat.st_size, stat.st_mtime, journal, source, extra_args)
+      else:
+         s3.upload_file(source, bucket, key, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
+      journal.complete(bucket, key, file, stat.st_size, stat.st_mtime)
+
+def upload_file(bucket, file, base_path = '', ignore_file_parent_folder = False, ignore_main_local_folder = False, journal = None):
+   path_in_bucket, filename, filename_in_bucket = get_key(file, base_path, ignore_file_parent_folder, ignore_main_local_folder)
    print(f'Uploading file {file}...')
-   s3.upload_file(file, bucket, filename_in_bucket)
+   send_file(bucket, file, filename_in_bucket, os.stat(file), journal)
 
    return path_in_bucket, filename
 
-def upload_path(bucket, path, base_path, ignore_file_parent_folder, ignore_main_local_folder):
-   metadata_info = []
+def try_upload_file(bucket, file, base_path, ignore_file_parent_folder, ignore_main_local_folder, existing = None, journal = None, stat = None, transformed = None):
+   # transformed: name of the object and path of the transformed copy of file to upload instead of file
+   source = transformed['file'] if transformed else file
+   try:
+      stat = stat or os.stat(file)
+      size = stat.st_size
+      path_in_bucket, filename_in_bucket, key = get_key(os.path.join(os.path.dirname(file), transformed['name']) if transformed else file, base_path, ignore_file_parent_folder, ignore_main_local_folder)
 
-   children_filenames = get_filepaths(path)
-   for child_filename in children_filenames:
-      path_in_bucket, filename_in_bucket = upload_file(bucket, child_filename, base_path, ignore_file_parent_folder, ignore_main_local_folder)
-      metadata_info.append({ 'path': path_in_bucket, 'file': filename_in_bucket })
-   
-   return metadata_info
+      # resume: files completed by the interrupted run are not sent again
+      if journal is not None and journal.is_completed(bucket, key, size, stat.st_mtime):
+         print(f'Skipping already uploaded file {file}')
+         return { 'local': file, 'path': path_in_bucket, 'file': filename_in_bucket, 'size': size, 'stored_size': None if transformed else size, 'skipped': True }
+
+      stored_size = os.path.getsize(source)
+
+      # sync: files already in the bucket with the same size and ETag are not sent again
+      if existing is not None and is_unchanged(source, stored_size, existing.get(key)):
+         print(f'Skipping unchanged file {file}')
+         return { 'local': file, 'path': path_in_bucket, 'file': filename_in_bucket, 'size': size, 'stored_size': stored_size, 'skipped': True }
+
+      print(f'Uploading file {file}...')
+      start = time.perf_counter()
+      send_file(bucket, file, key, stat, journal, source)
+      upload_s = time.perf_counter() - start
+   except (BotoCoreError, ClientError, S3UploadFailedError, OSError) as error:
+      print(f'Failed to upload file {file}: {error}', file=sys.stderr)
+      return { 'local': file, 'error': str(error) }
+   finally:
+      if transformed and transformed['file']:
+         try:
+            os.remove(transformed['file'])
+         except OSError:
+            pass
+
+   return { 'local': file, 'path': path_in_bucket, 'file': filename_in_bucket, 'size': size, 'stored_size': stored_size, 'skipped': False,
+      'upload_s': upload_s, 'transform_s': transformed['transform_s'] if transformed else None }
+
+def try_upload_stream(bucket, stream, name, base_path, ignore_file_parent_folder, ignore_main_local_folder, compression = None):
+   try:
+      path_in_bucket, filename_in_bucket, key = get_key(name, base_path, ignore_file_parent_folder, ignore_main_local_folder)
+      if compression:
+         filename_in_bucket = filename_in_bucket + COMPRESSION_SUFFIXES[compression]
+         key = key + COMPRESSION_SUFFIXES[compression]
+      print(f'Uploading {name}...')
+      start = time.perf_counter()
+      uploaded = upload_stream(stream, bucket, key, compression)
+      upload_s = time.perf_counter() - start
+   except (BotoCoreError, ClientError, OSError, tarfile.TarError) as error:
+      print(f'Failed to upload {name}: {error}', file=sys.stderr)
+      return { 'local': name, 'error': str(error) }
+
+   return { 'local': name, 'path': path_in_bucket, 'file': filename_in_bucket, 'size': uploaded['size'], 'stored_size': uploaded['stored_size'], 'skipped': False, 'upload_s': upload_s }
+
+def upload_stdin(bucket, name, stdin_format, base_path, ignore_file_parent_folder, ignore_main_local_folder, compression = None):
+   stream = sys.stdin.buffer
 
+   if stdin_format == 'tar':
+      # the files of the archive are uploaded as they are read, as if it was extracted to the folder name
+      with tarfile.open(fileobj=stream, mode='r|*') as archive:
+         for member in archive:
+            if member.isfile():
+               yield try_upload_stream(bucket, archive.extractfile(member), os.path.join(name, member.name), base_path, ignore_file_parent_folder, ignore_main_local_folder, compression)
+   else:
+      yield try_upload_stream(bucket, stream, name, base_path, ignore_file_parent_folder, ignore_main_local_folder, compression)
+
+def upload_path(bucket, path, base_path, ignore_file_parent_folder, ignore_main_local_folder, workers = DEFAULT_WORKERS, existing = None, journal = None, compression = None, to_parquet = False, transform_workers = None):
+   # files are submitted while the folder is walked, with at most two waiting per worker,
+   # and the results are yielded as the uploads complete;
+   # files to compress or convert go through the transform processes first, the upload threads only send them
+   transform = compression is not None or to_parquet
+   transform_workers = transform_workers or os.cpu_count()
+   limit = 2 * workers + (transform_workers if transform else 0)
+
+   with ThreadPoolExecutor(max_workers=workers) as executor, \
+         (ProcessPoolExecutor(max_workers=transform_workers, mp_context=multiprocessing.get_context('spawn')) if transform else nullcontext()) as transformer, \
+         (tempfile.TemporaryDirectory() if transform else nullcontext()) as directory:
+      # pending futures: uploads, or transforms with the file and stat to upload once they are done
+      pending = {}
+
+      def complete():
+         done, _ = wait(pending, return_when=FIRST_COMPLETED)
+         for future in done:
+            transformed_file = pending.pop(future)
+            if transformed_file is None:
+               yield future.result()
+               continue
+            file, stat = transformed_file
+            try:
+               transformed = future.result()
+            except Exception as error:
+               print(f'Failed to transform file {file}: {error}', file=sys.stderr)
+               yield { 'local': file, 'error': str(error) }
+               continue
+            pending[executor.submit(try_upload_file, bucket, file, base_path, ignore_file_parent_folder, ignore_main_local_folder, existing, journal, stat, transformed)] = None
+
+      for child_filename, stat in walk_files(path):
+         while len(pending) >= limit:
+            yield from complete()
+
+         name = transformed_name(os.path.basename(child_filename), compression, to_parquet) if transform else None
+         if name is None:
+            pending[executor.submit(try_upload_file, bucket, child_filename, base_path, ignore_file_parent_folder, ignore_main_local_folder, existing, journal, stat)] = None
+         elif journal is not None and journal.is_completed(bucket, get_key(os.path.join(os.path.dirname(child_filename), name), base_path, ignore_file_parent_folder, ignore_main_local_folder)[2], stat.st_size, stat.st_mtime):
+            # resume: no need to transform a file that was already uploaded
+            pending[executor.submit(try_upload_file, bucket, child_filename, base_path, ignore_file_parent_folder, ignore_main_local_folder, existing, journal, stat, { 'name': name, 'file': None })] = None
+         else:
+            pending[transformer.submit(transform_file, child_filename, directory, name, compression, to_parquet)] = (child_filename, stat)
+
+      while pending:
+         yield from complete()
 
 if __name__ == '__main__':
    parser = argparse.ArgumentParser(description="Script to upload files to s3 bucket.")
@@ -92,10 +688,54 @@ if __name__ == '__main__':
    parser.add_argument('--no-local-file-parent', help='Ignore local file parent. example: local file grand_parent/parent/child.txt will be uploaded as grand_parent/child.txt', action="store_true")
    parser.add_argument('--metadata', help='Generate and upload a metadata file with the path and name for the files uploaded in the folder', action="store_true")
    parser.add_argument('--no-main-local-folder', help='To do not include main local folder in the bucket directory structure. excample: local file main-folder/a/b/file.txt will be uploaded as /a/b/file.txt', action="store_true")
-   parser.add_argument('--paths-to-upload', help='local path to be uploaded', nargs='+', action='store', required=True)
+   parser.add_argument('--paths-to-upload', help='local path to be uploaded', nargs='+', action='store')
+   parser.add_argument('--stdin', help='Upload the data read from the standard input as the file NAME, or with --stdin-format tar the files of the archive as if it was extracted to the folder NAME', metavar='NAME')
+   parser.add_argument('--stdin-format', help='Format of the data read with --stdin (default: raw)', choices=['raw', 'tar'], default='raw')
+   parser.add_argument('--compress', help='Compress the files (or the data read with --stdin) before uploading them, adding .gz or .zst to their name (zstd needs zstandard)', choices=list(COMPRESSION_SUFFIXES))
+   parser.add_argument('--to-parquet', help='Convert the CSV files to Parquet before uploading them (needs pyarrow)', action="store_true")
+   parser.add_argument('--transform-workers', help='Number of processes compressing or converting the files (default: number of CPUs)', type=int)
+   parser.add_argument('--sync', help='Only upload files that are new or changed: files already in the bucket with the same size and ETag are skipped', action="store_true")
+   parser.add_argument('--journal', help='SQLite file recording the files uploaded and the parts of multipart uploads, to resume the run if it is interrupted')
+   parser.add_argument('--resume', help='Continue the run recorded in --journal: completed files are skipped and partial multipart uploads are continued', action="store_true")
+   parser.add_argument('--compact', help='Instead of uploading, merge the metadata parts written by the runs of a month (YYYY-MM, default: current month) into the monthly metadata file', nargs='?', const=date.today().strftime('%Y-%m'), metavar='YYYY-MM')
+   parser.add_argument('--compact-format', help='Format of the compacted monthly metadata file (default: csv)', choices=['csv', 'parquet'], default='csv')
+   parser.add_argument('--workers', help=f'Number of files uploaded at the same time (default: {DEFAULT_WORKERS})', type=int, default=DEFAULT_WORKERS)
+   parser.add_argument('--profile', help='Report the size, upload time and throughput of each file and of the run to a .json or .csv file, or print the run summary with no file', nargs='?', const='-', metavar='FILE')
 
    args = parser.parse_args()
 
+   if args.workers < 1:
+      parser.error('--workers must be at least 1')
+
+   if args.resume and not args.journal:
+      parser.error('--resume requires --journal')
+
+   if not args.paths_to_upload and not args.compact and not args.stdin:
+      parser.error('the following arguments are required: --paths-to-upload')
+
+   if args.stdin and args.paths_to_upload:
+      parser.error('--stdin and --paths-to-upload cannot be used together')
+
+   if args.to_parquet and args.stdin:
+      parser.error('--to-parquet cannot be used with --stdin')
+
+   if args.transform_workers is not None and args.transform_workers < 1:
+      parser.error('--transform-workers must be at least 1')
+
+   try:
+      if args.compress == 'zstd':
+         import zstandard
+      if args.to_parquet:
+         import pyarrow
+   except ImportError as error:
+      parser.error(f'{error.name} is not installed: pip install {error.name}')
+
+   if args.compact:
+      try:
+         compact_date = datetime.strptime(args.compact, '%Y-%m')
+      except ValueError:
+         parser.error('--compact expects a month as YYYY-MM')
+
    bucket = args.bucket
    main_folder_in_bucket = args.target_folder
    use_date_bucket_paths = args.use_date_paths
@@ -104,9 +744,17 @@ if __name__ == '__main__':
    ignore_main_local_folder = args.no_main_local_folder
 
    paths = args.paths_to_upload
+   workers = args.workers
+
+   if workers > DEFAULT_WORKERS:
+      s3 = create_client(workers)
 
    target_bucket_folder = main_folder_in_bucket
 
+   if args.compact:
+      compact_metadata(bucket, f'{main_folder_in_bucket}/metadata-{compact_date.year}-{compact_date.month}', args.compact_format)
+      sys.exit(0)
+
    run_date = date.today()
 
    year = run_date.year
@@ -116,20 +764,67 @@ if __name__ == '__main__':
    if use_date_bucket_paths:
       target_bucket_folder = "/".join([main_folder_in_bucket,f'year={year}',f'month={month}',f'day={day}'])
 
-   metadata_info = []
+   profile = UploadProfile() if args.profile else None
 
-   for path in paths:
-      str_path = str(path)
-      metadata_info_path = upload_path(bucket, str_path, target_bucket_folder, ignore_file_parent_folder, ignore_main_local_folder)
-      metadata_info = metadata_info + metadata_info_path
-   
-   if generate_metadata:
-      metadata_file_name = f'{main_folder_in_bucket}/metadata-{year}-{month}.csv'
-      
-      with S3File(bucket, metadata_file_name) as buf:
-               writer = csv.writer(buf)
-
-               for metadata_path in metadata_info:
-                  if buf.tell() == 0:
-                     writer.writerow(METADATA_HEADERS)
-                  writer.writerow([metadata_path['path'], metadata_path['file'], run_date])
\ No newline at end of file
+   uploaded = 0
+   skipped = 0
+   skipped_bytes = 0
+   failed = 0
+
+   # the target folder is listed once, instead of one request per file
+   existing = list_objects(bucket, target_bucket_folder) if args.sync else None
+
+   journal = UploadJournal(args.journal) if args.journal else None
+
+   if journal is not None and not args.resume:
+      # new run: multipart uploads left by a previous run are aborted so their parts are not kept in the bucket
+      for pending_bucket, pending_key, upload_id in journal.pending_uploads():
+         try:
+            s3.abort_multipart_upload(Bucket=pending_bucket, Key=pending_key, UploadId=upload_id)
+         except ClientError:
+            pass
+      journal.reset()
+
+   metadata_prefix = f'{main_folder_in_bucket}/metadata-{year}-{month}'
+
+   # metadata rows are written as the uploads complete, to a part of the monthly metadata for this run
+   with ManifestPart(bucket, metadata_prefix) if generate_metadata else nullcontext() as buf:
+      writer = csv.writer(buf) if generate_metadata else None
+
+      if args.stdin:
+         results = upload_stdin(bucket, args.stdin, args.stdin_format, target_bucket_folder, ignore_file_parent_folder, ignore_main_local_folder, args.compress)
+      else:
+         results = itertools.chain.from_iterable(upload_path(bucket, str(path), target_bucket_folder, ignore_file_parent_folder, ignore_main_local_folder, workers, existing, journal, args.compress, args.to_parquet, args.transform_workers) for path in paths)
+
+      for result in results:
+         if profile is not None:
+            profile.add(result)
+
+         if 'error' in result:
+            failed += 1
+            continue
+
+         if result['skipped']:
+            # already in the bucket and in the metadata of the run that uploaded it
+            skipped += 1
+            skipped_bytes += result['size']
+            continue
+
+         uploaded += 1
+         if writer is not None:
+            if buf.tell() == 0:
+               writer.writerow(METADATA_HEADERS)
+            writer.writerow([result['path'], result['file'], run_date, result['size'], result['stored_size']])
+
+   if journal is not None:
+      journal.close()
+
+   if profile is not None:
+      profile.write(args.profile)
+
+   if args.sync or args.resume:
+      print(f"Skipped {skipped} unchanged or already uploaded files ({skipped_bytes} bytes not uploaded)")
+
+   if failed:
+      print(f'{failed} of {uploaded + skipped + failed} files failed to upload', file=sys.stderr)
+      sys.exit(1)
\ No newline at end of file
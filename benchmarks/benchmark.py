@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import nullcontext, redirect_stdout
+from datetime import datetime
+
+import generate
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RETENTION=os.path.join(ROOT, 'retention', 'retention.py')
+UPLOADER=os.path.join(ROOT, 'aws', 's3-uploader')
+
+#outputs of the retention.py runs, their stages are timed by retention.py --profile
+RETENTION_OUTPUTS=['--out-all', '{out}/retention_all.csv', '--out-groupby', '{out}/retention_groupby.csv', '--out-plm', '{out}/plm.csv']
+
+#run a command, with its wall time, CPU time and peak memory (its own and its worker processes')
+def measure(command):
+    start=time.perf_counter()
+    process=subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall=time.perf_counter()-start
+    process.returncode=os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        sys.exit(f"{' '.join(command)} failed with exit code {process.returncode}")
+    #ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    peak=usage.ru_maxrss/1024/1024 if sys.platform=='darwin' else usage.ru_maxrss/1024
+    return {'wall_s':wall, 'cpu_s':usage.ru_utime+usage.ru_stime, 'peak_rss_mb':peak}
+
+def checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+#time retention.py stage by stage on the generated posts; repeated runs keep the fastest
+def benchmark_retention(folder, rows, args):
+    out=os.path.join(folder, 'out')
+    os.makedirs(out, exist_ok=True)
+    profile=os.path.join(folder, 'profile.json')
+    command=[sys.executable, RETENTION, '-f', os.path.join(folder, 'posts'), '-t', args.timeframe,
+             '-g', args.groupby, '--workers', str(args.workers),
+             '--brand-group', os.path.join(folder, 'brand_group.csv'),
+             '--profile', profile]+[option.format(out=out) for option in RETENTION_OUTPUTS]
+    if args.brand_list:
+        command+=['--brand-list', os.path.join(folder, 'brand_list.csv')]
+
+    fastest=None
+    for i in range(args.repeat):
+        print(f'Running retention.py ({i+1}/{args.repeat})...')
+        run=measure(command)
+        if fastest is None or run['wall_s']<fastest[0]['wall_s']:
+            with open(profile) as f:
+                fastest=(run, json.load(f))
+
+    #the stages of the fastest run, and the run as measured from outside (with the interpreter start and the worker processes)
+    run, report = fastest
+    stages={entry.pop('stage'):entry for entry in report}
+    stages['run']=dict(run, rows=rows, rows_per_s=rows/run['wall_s'] if run['wall_s'] else None)
+
+    #the outputs are hashed so runs of two versions can be checked to give the same numbers
+    checksums={os.path.basename(path):checksum(path) for path in sorted(glob.glob(os.path.join(out, '*.csv')))}
+    return stages, checksums
+
+#files to upload: parts of the generated post files, of about file_size bytes each
+def write_upload_files(folder, count, file_size):
+    upload_folder=os.path.join(folder, 'upload')
+    os.makedirs(upload_folder, exist_ok=True)
+    with open(sorted(glob.glob(os.path.join(folder, 'posts', '*.csv')))[0], 'rb') as f:
+        data=f.read(file_size*min(count, 100))
+    for i in range(count):
+        offset=(i%100)*file_size%max(len(data)-file_size, 1)
+        with open(os.path.join(upload_folder, f'part-{i:06d}.csv'), 'wb') as f:
+            f.write(data[offset:offset+file_size])
+    return upload_folder
+
+#time upload.py on a folder of files, for each number of workers
+#the bucket is a local S3 stand-in: moto in the same process, or the endpoint of AWS_ENDPOINT_URL (moto server, MinIO...)
+def benchmark_upload(folder, args):
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    upload_folder=write_upload_files(folder, args.upload_files, args.upload_file_size)
+    size=sum(os.path.getsize(path) for path in glob.glob(os.path.join(upload_folder, '*')))
+
+    if os.environ.get('AWS_ENDPOINT_URL'):
+        stand_in=nullcontext()
+    else:
+        try:
+            from moto import mock_aws
+        except ImportError:
+            sys.exit('The upload benchmark needs moto (pip install moto) or AWS_ENDPOINT_URL set to a local S3 stand-in')
+        stand_in=mock_aws()
+
+    results=[]
+    with stand_in:
+        sys.path.insert(0, UPLOADER)
+        import upload
+
+        for workers in [int(w) for w in args.upload_workers.split(',')]:
+            print(f'Running upload.py: {workers} workers...')
+            bucket=f'benchmark-{os.getpid()}-{workers}'
+            upload.s3=upload.create_client(workers)
+            upload.s3.create_bucket(Bucket=bucket)
+
+            tracemalloc.start()
+            start=time.perf_counter()
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                uploaded=list(upload.upload_path(bucket, upload_folder, 'benchmark', False, False, workers, compression=args.upload_compress))
+            wall=time.perf_counter()-start
+            peak=tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            failed=[result for result in uploaded if 'error' in result]
+            if failed:
+                sys.exit(f"{len(failed)} files failed to upload: {failed[0]['error']}")
+            results.append({'workers':workers, 'files':len(uploaded), 'bytes':size, 'wall_s':wall,
+                            'files_per_s':len(uploaded)/wall, 'mb_per_s':size/wall/1024/1024,
+                            'peak_python_memory_mb':peak/1024/1024})
+    return results
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Benchmark retention.py and upload.py on synthetic post exports")
+    generate.add_arguments(parser)
+    parser.add_argument('-t','--timeframe', help='Timeframes of the retention.py runs (default: quarter)', default='quarter')
+    parser.add_argument('-g','--groupby', help='Groupby of the retention.py runs (default: category,group,beauty_group)', default='category,group,beauty_group')
+    parser.add_argument('--brand-list', help='Also filter the posts with a brand list', action='store_true')
+    parser.add_argument('--workers', help='Number of processes loading the post files in retention.py (default: 1)', type=int, default=1)
+    parser.add_argument('--repeat', help='Number of runs of each retention.py stage, the fastest is kept (default: 1)', type=int, default=1)
+    parser.add_argument('--upload-files', help='Number of files of the upload benchmark (default: 1000)', type=int, default=1000)
+    parser.add_argument('--upload-file-size', help='Size in bytes of the files of the upload benchmark (default: 10000)', type=int, default=10000)
+    parser.add_argument('--upload-workers', help='Numbers of upload workers to benchmark, separated by commas (default: 1,8,32)', default='1,8,32')
+    parser.add_argument('--upload-compress', help='Compress the files in the upload benchmark', choices=['gzip', 'zstd'])
+    parser.add_argument('--skip-retention', help='Do not benchmark retention.py', action='store_true')
+    parser.add_argument('--skip-upload', help='Do not benchmark upload.py', action='store_true')
+    parser.add_argument('--data', help='Folder to generate the data in, kept after the run (default: temporary folder)')
+    parser.add_argument('-o','--output', help='JSON file of the results (default: benchmark.json)', default='benchmark.json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        folder=args.data or temporary
+        print(f'Generating posts in {folder}...')
+        start=time.perf_counter()
+        rows=generate.write_dataset(folder, args.files, **generate.dataset_options(args))
+        size=sum(os.path.getsize(path) for path in glob.glob(os.path.join(folder, 'posts', '*.csv')))
+
+        report={
+            'date':datetime.now().isoformat(timespec='seconds'),
+            'python':platform.python_version(),
+            'machine':{'platform':platform.platform(), 'cpus':os.cpu_count()},
+            'options':vars(args),
+            'data':{'rows':rows, 'files':args.files, 'bytes':size, 'generate_s':time.perf_counter()-start},
+        }
+        if not args.skip_retention:
+            report['retention'], report['checksums'] = benchmark_retention(folder, rows, args)
+        if not args.skip_upload:
+            report['upload']=benchmark_upload(folder, args)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {args.output}')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+#columns of the post exports, as read by retention.py
+COLUMNS=['date','mentions','influencer_uid','post_uid','category','group','influencer_name','tiers',
+        'audience_size','total_engagements','video_views','reach_for_eng','reach_for_vv']
+CATEGORIES=['skincare','makeup','hair','fragrance']
+#audience size thresholds of the tiers
+TIERS={'nano':0, 'micro':10000, 'mid':50000, 'macro':500000, 'mega':1000000}
+BEAUTY_GROUPS=['L','C1','C2','C3']
+
+#synthetic post export: each influencer is active in a month with probability 1-sparsity and then posts
+#about one of its few favourite brands, posts_per_influencer times on average
+#a small share of the rows is invalid (mentions 0 or not a number) as in real exports
+def generate_posts(influencers=10000, periods=24, groups=50, posts_per_influencer=3, sparsity=0.7, start='2020-01', seed=0):
+    rng=np.random.default_rng(seed)
+
+    #influencers active by month, and the number of posts of each active month
+    active=np.nonzero(rng.random((influencers, periods))>=sparsity)
+    counts=1+rng.poisson(max(posts_per_influencer-1, 0), len(active[0]))
+    influencer=np.repeat(active[0], counts)
+    month=np.repeat(active[1], counts)
+    rows=len(influencer)
+
+    #posting date: any second of the month, in UTC
+    months=np.datetime64(start, 'M')+month
+    seconds=(rng.random(rows)*((months+1).astype('datetime64[s]')-months.astype('datetime64[s]')).astype(np.int64)).astype(np.int64)
+    dates=np.char.add(np.datetime_as_string(months.astype('datetime64[s]')+seconds, unit='s'), '+0000')
+
+    #brands: popularity decreasing with their rank, each influencer sticks to three of them
+    popularity=1/np.arange(1, groups+1)
+    favourites=rng.choice(groups, size=(influencers, 3), p=popularity/popularity.sum())
+    brand=favourites[influencer, rng.integers(0, 3, rows)]
+    brand_names=np.array([f'brand{b:04d}' for b in range(groups)], dtype=object)
+    brand_categories=np.array(CATEGORIES, dtype=object)[np.arange(groups)%len(CATEGORIES)]
+
+    #influencer profile
+    audience=np.round(rng.lognormal(9, 1.5, influencers)).astype(np.int64)
+    tiers=np.array(list(TIERS), dtype=object)[np.searchsorted(list(TIERS.values()), audience, side='right')-1]
+    uids=np.array([f'u{i:07d}' for i in range(influencers)], dtype=object)
+    names=np.array([f'influencer {i}' for i in range(influencers)], dtype=object)
+
+    engagements=rng.poisson(audience[influencer]*0.03)
+    video=rng.random(rows)<0.4
+    posts=pd.DataFrame({
+        'date':dates,
+        'mentions':rng.choice(['1','1','1','1','1','1','1','1','2','3','0','n/a'], rows),
+        'influencer_uid':uids[influencer],
+        'post_uid':np.char.add('p', np.arange(rows).astype(str)),
+        'category':brand_categories[brand],
+        'group':brand_names[brand],
+        'influencer_name':names[influencer],
+        'tiers':tiers[influencer],
+        'audience_size':audience[influencer],
+        'total_engagements':engagements,
+        'video_views':np.where(video, rng.poisson(audience[influencer]*0.2), 0),
+        'reach_for_eng':np.where(engagements>0, audience[influencer], 0),
+        'reach_for_vv':np.where(video, audience[influencer], 0),
+    })
+    #exports are not sorted by date
+    return posts.iloc[rng.permutation(rows)].reset_index(drop=True)
+
+#brand taxonomy (--brand-group), with a few brands listed twice as in the real taxonomy files
+def generate_brand_group(groups=50, seed=0):
+    rng=np.random.default_rng(seed)
+    brand_group=pd.DataFrame({'brand_id':[f'brand{b:04d}' for b in range(groups)],
+                              'beauty_group':rng.choice(BEAUTY_GROUPS, groups)})
+    return pd.concat([brand_group, brand_group.sample(frac=0.05, random_state=seed)], ignore_index=True)
+
+#subset of the brands (--brand-list)
+def generate_brand_list(groups=50, seed=0):
+    return pd.DataFrame({'group':[f'brand{b:04d}' for b in range(groups)]}).sample(frac=0.8, random_state=seed).sort_index()
+
+#write the posts as a folder of post files, with the brand files next to it
+def write_dataset(folder, files=1, **options):
+    os.makedirs(os.path.join(folder, 'posts'), exist_ok=True)
+    posts=generate_posts(**options)
+    for i in range(files):
+        posts.iloc[i::files].to_csv(os.path.join(folder, 'posts', f'posts-{i:03d}.csv'), index=False)
+    groups=options.get('groups', 50)
+    seed=options.get('seed', 0)
+    generate_brand_group(groups, seed).to_csv(os.path.join(folder, 'brand_group.csv'), index=False)
+    generate_brand_list(groups, seed).to_csv(os.path.join(folder, 'brand_list.csv'), index=False)
+    return len(posts)
+
+def add_arguments(parser):
+    parser.add_argument('--influencers', help='Number of influencers (default: 10000)', type=int, default=10000)
+    parser.add_argument('--periods', help='Number of months of posts (default: 24)', type=int, default=24)
+    parser.add_argument('--groups', help='Number of brands (default: 50)', type=int, default=50)
+    parser.add_argument('--posts-per-influencer', help='Average number of posts of an influencer in a month it is active (default: 3)', type=float, default=3)
+    parser.add_argument('--sparsity', help='Probability that an influencer is not active in a month (default: 0.7)', type=float, default=0.7)
+    parser.add_argument('--start', help='First month of posts, YYYY-MM (default: 2020-01)', default='2020-01')
+    parser.add_argument('--files', help='Number of post files the posts are split into (default: 1)', type=int, default=1)
+    parser.add_argument('--seed', help='Random seed (default: 0)', type=int, default=0)
+
+def dataset_options(args):
+    return {'influencers':args.influencers, 'periods':args.periods, 'groups':args.groups,
+            'posts_per_influencer':args.posts_per_influencer, 'sparsity':args.sparsity, 'start':args.start, 'seed':args.seed}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic post exports for retention.py")
+    parser.add_argument('folder', help='Folder to write posts/*.csv, brand_group.csv and brand_list.csv to')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    rows=write_dataset(args.folder, args.files, **dataset_options(args))
+    print(f'Wrote {rows} posts to {args.folder}')
@@ -4,476 +4,1189 @@ import sys
 import os
 import glob
 import argparse
+import contextlib
 import csv
-import pandas as pd
-import numpy as np
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+import tracemalloc
+import zoneinfo
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import datetime
 from datetime import datetime
-import dateutil.parser
-from dateutil import tz
-
-parser = argparse.ArgumentParser(description="Scripts to calculate retention rate over periods")
-parser.add_argument('-p','--posts', help='Single post file from an IMB (export folder))')
-parser.add_argument('-f','--folder', help='Folder of multiple post files from IMBs (export folder)')
-parser.add_argument('-g','--groupby', help='Filters to partition the data')
-parser.add_argument('-t','--timeframe', help='Set the timeframe for the aggregation. month|quarter|half-year|year',required=True)
-parser.add_argument('--brand-list', help='CSV file of a subset of brands')
-parser.add_argument('--brand-group', help='CSV file of taxonomy of brands')
-parser.add_argument('--group-fillna', help='Fill NAs with Competitor - for loreal only',action='store_true')
-parser.add_argument('--sapmena', help='For SAPMENA projects only - change retained rate to retention rate per request',action='store_true')
-parser.add_argument('--out-all', help='Output the overall retention rates')
-parser.add_argument('--out-groupby', help='Output the retention rates for groupby items')
-parser.add_argument('--out-plm', help='Output the influencer list with performance metrics for groupby items')
-args = parser.parse_args()
-
-if args.posts:
-    posts=pd.read_csv(args.posts,low_memory=False)
-elif args.folder:
-    #import multiple post files from a folder
-    path=args.folder
-    files = glob.glob(path+'/*.csv')
-    dfs = [pd.read_csv(f) for f in files]
-    posts = pd.concat(dfs)
-
-if args.brand_list:
-    brands=pd.read_csv(args.brand_list, low_memory=False)
-    posts=posts.merge(brands, on='group', how='left', indicator=True)
-    posts=posts.loc[posts['_merge']=='both']
-else:
-    pass
-
-if args.brand_group:
-    #import brand taxonomy -- optional
-    brand_group=pd.read_csv(args.brand_group, low_memory=False)
-    #left outer join and add tiers for posts
-    posts=posts.merge(brand_group[['brand_id','beauty_group']], 
-                                left_on='group', right_on='brand_id', 
-                                how='left').drop('brand_id', axis=1)
-    posts.drop_duplicates(subset=None, keep="first", inplace=True)
-else:
-    pass
-
-
-#include valid posts only (mentions>=1)
-posts['mentions']=pd.to_numeric(posts['mentions'],errors='coerce')
-posts=posts.loc[posts['mentions']>=1]
-
-#set the timeframe (month, quarter, half-year, year)
-timeframe=args.timeframe
-
-#format date column
-posts['date'] = pd.to_datetime(posts['date'], errors='coerce') #format='%d%b%Y:%H:%M:%S.%f')
-posts['date'] = posts['date'].dt.tz_convert('US/Eastern')
-posts['year'] = posts['date'].dt.year.astype(str)
-
-#define the timeframe for the analysis
-if timeframe=='month':
-    posts['timeframe'] = posts['year']+'-'+posts['date'].dt.quarter.astype(str)
-elif timeframe=='quarter':
-    posts['timeframe'] = posts['year']+'-Q'+posts['date'].dt.quarter.astype(str)
-elif timeframe=='half-year':
-    posts['timeframe'] = posts['year']+'-H'+np.ceil(posts['date'].dt.month.astype(int)/6).astype(int).astype(str)
-elif timeframe=='year':
-    posts['timeframe'] = posts['year']
-
 
-#fillna for beauty_group with "Competitor" -- if loreal only
-if args.group_fillna:
-    posts.fillna({'beauty_group':'Competitor'}, inplace=True)
+#pandas and numpy are imported on first use: the command line answers -h and option errors right away,
+#and importing the engine costs nothing until it runs
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec=importlib.util.find_spec(name)
+    spec.loader=importlib.util.LazyLoader(spec.loader)
+    module=importlib.util.module_from_spec(spec)
+    sys.modules[name]=module
+    spec.loader.exec_module(module)
+    return module
 
+pd=lazy_import('pandas')
+np=lazy_import('numpy')
 
-if args.groupby:
-#define groupby
-    groupby=args.groupby.split(",")
+#number of months in each timeframe
+TIMEFRAMES={'month':1, 'quarter':3, 'half-year':6, 'year':12}
 
-    #define columns for the aggregation
-    columns_all_freq=['timeframe','influencer_uid','post_uid']
-    columns_groupby_freq=['timeframe']+groupby+['influencer_uid','post_uid']
+#outputs of RetentionEngine.run
+OUTPUTS=['all','groupby','plm','cohort','cohort_groupby','state']
 
-    columns_all=['timeframe','influencer_uid']
-    columns_groupby=['timeframe']+groupby+['influencer_uid']
+#performance metrics and the columns they are reported by (--out-plm)
+metrics=['mentions','total_engagements','video_views','reach_for_eng','reach_for_vv']
+columns_perf=['category','group','beauty_group','influencer_uid','influencer_name','tiers','audience_size']
 
+#row labels of the retention tables, in output order
+COUNT_ROWS=['Total','Acquired','Retained','Churned']
+RATE_ROWS=['Acquisition_rate','Retention_rate','Churn_rate','Retained_rate']
 
-    #get unique influencers on post level
+#--profile: stage report columns
+PROFILE_COLUMNS=['stage','calls','rows','wall_s','cpu_s','rows_per_s','peak_rss_mb','peak_traced_mb']
 
-    #posts_freq: specify number of mentions
-    #posts: use 0/1 to indicate if the brands are mentioned
-    posts_all_freq=posts[columns_all_freq].drop_duplicates()
-    posts_groupby_freq=posts[columns_groupby_freq].drop_duplicates()
+#post files written by upload.py: CSV (plain, or compressed with --compress) or Parquet (--to-parquet)
+S3_SUFFIXES={'.csv':None, '.csv.gz':'gzip', '.csv.zst':'zstd', '.parquet':None}
+#size of the ranges downloaded concurrently
+S3_RANGE=8*1024*1024
 
-    posts_all=posts[columns_all].drop_duplicates()
-    posts_groupby=posts[columns_groupby].drop_duplicates()
 
-    #create pivot table for overall (fill all na values with 0)
-    table_all_freq=posts_all_freq.pivot_table(index='influencer_uid',columns='timeframe', aggfunc='size', fill_value=0).reset_index()
-    table_all=posts_all.pivot_table(index='influencer_uid',columns='timeframe', aggfunc='size', fill_value=0).reset_index()
-
-
-    #merge columns with delimiter if data needs to be groupped by more than two filters
-    if len(groupby)>=2:
-        posts_groupby_freq['combined'] = posts_groupby_freq[groupby].apply(lambda row: '_'.join(row.values.astype(str)), axis=1)
-        posts_groupby['combined'] = posts_groupby[groupby].apply(lambda row: '_'.join(row.values.astype(str)), axis=1)
-    else:
-        posts_groupby_freq['combined'] = posts_groupby_freq[groupby]
-        posts_groupby['combined'] = posts_groupby[groupby]
+#errors of the inputs (files, state) found while running, reported by the command line as they are
+class RetentionError(Exception):
+    pass
 
-    #create pivot table for groupby (fill all na values with 0)
-    table_groupby_freq=posts_groupby_freq.pivot_table(index=['combined','influencer_uid'],columns='timeframe', aggfunc='size', fill_value=0).reset_index()
-    table_groupby=posts_groupby.pivot_table(index=['combined','influencer_uid'],columns='timeframe', aggfunc='size', fill_value=0).reset_index()
 
+#peak resident memory of the process in MB, None where the resource module is missing (Windows)
+#ru_maxrss is in bytes on macOS and in kilobytes on Linux
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1024/1024 if sys.platform=='darwin' else rss/1024
+
+
+def split_s3_url(url):
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+def s3_suffix(key):
+    for suffix in S3_SUFFIXES:
+        if key.lower().endswith(suffix):
+            return suffix
+    return None
+
+#ranged GET of bytes start..end-1 of an S3 object (If-Match makes sure all the ranges come from the version that was listed)
+def get_range(client, bucket, key, etag, start, end):
+    return client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end-1}', IfMatch=etag)['Body'].read()
+
+#S3 object read from start to end as a stream of its ranges, downloaded ahead by workers threads
+#at most workers ranges are held at a time, so a file is parsed chunk by chunk in flat memory whatever its size
+class S3RangeStream(io.RawIOBase):
+    def __init__(self, client, bucket, key, size, etag, workers):
+        super().__init__()
+        self.fetch=lambda start: get_range(client, bucket, key, etag, start, min(start+S3_RANGE, size))
+        self.pool=ThreadPoolExecutor(max_workers=workers)
+        self.starts=iter(range(0, size, S3_RANGE))
+        self.pending=deque(self.pool.submit(self.fetch, start) for start in itertools.islice(self.starts, workers))
+        self.data=memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self.data):
+            if not self.pending:
+                return 0
+            self.data=memoryview(self.pending.popleft().result())
+            start=next(self.starts, None)
+            if start is not None:
+                self.pending.append(self.pool.submit(self.fetch, start))
+        n=min(len(buffer), len(self.data))
+        buffer[:n]=self.data[:n]
+        self.data=self.data[n:]
+        return n
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
+#S3 object as a seekable file: each read is a ranged GET of the bytes asked for
+#(Parquet files are read from their footer, then only the column chunks of the columns needed)
+class S3RangeFile(io.RawIOBase):
+    def __init__(self, client, bucket, key, size, etag):
+        super().__init__()
+        self.fetch=lambda start, end: get_range(client, bucket, key, etag, start, end)
+        self.size=size
+        self.position=0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.position={io.SEEK_SET:0, io.SEEK_CUR:self.position, io.SEEK_END:self.size}[whence]+offset
+        return self.position
+
+    def readinto(self, buffer):
+        end=min(self.position+len(buffer), self.size)
+        if end<=self.position:
+            return 0
+        data=self.fetch(self.position, end)
+        buffer[:len(data)]=data
+        self.position+=len(data)
+        return len(data)
+
+# DATES
+#UTC dates of a column of posts, NaT for dates that can't be read
+#exports repeat the same timestamps over many posts: each distinct string is parsed once, with date_format
+#or else the fixed format guessed from the first dates (dates without a timezone are taken as UTC)
+def parse_dates(dates, date_format=None):
+    if isinstance(dates.dtype, pd.DatetimeTZDtype):
+        return pd.DatetimeIndex(dates).tz_convert('UTC')
+    if dates.dtype.kind=='M':
+        return pd.DatetimeIndex(dates).tz_localize('UTC')
+    codes, uniques = pd.factorize(dates)
+    if date_format is None:
+        date_format=next((f for f in map(pd.tseries.api.guess_datetime_format, uniques[:100].astype(str)) if f), None)
+    parsed=pd.to_datetime(pd.Index(uniques), errors='coerce', format=date_format, utc=True)
+    return parsed.take(codes, allow_fill=True, fill_value=pd.NaT)
+
+#month codes (months since year 0) of UTC dates in a timezone, -1 for missing dates
+#the dates are placed among the starts of the months in the timezone instead of converting each of them to local time
+def month_codes(dates, timezone):
+    values=dates.as_unit('ns').asi8
+    valid=np.asarray(dates.notna())
+    if not valid.any():
+        return np.full(len(values), -1, dtype=np.int32)
+    #from the month before the first date to the month after the last one, whatever the timezone offset
+    low=pd.Timestamp(values[valid].min(), tz='UTC')
+    high=pd.Timestamp(values[valid].max(), tz='UTC')
+    first=low.year*12+low.month-2
+    starts=pd.DatetimeIndex([datetime(code//12, code%12+1, 1) for code in range(first, high.year*12+high.month+2)])
+    #a month starting in a DST change begins at the first local midnight, or the first hour after a skipped one
+    starts=starts.tz_localize(timezone, ambiguous=np.ones(len(starts), dtype=bool), nonexistent='shift_forward').as_unit('ns').asi8
+    codes=np.searchsorted(starts, values, side='right')-1+first
+    return np.where(valid, codes, -1).astype(np.int32)
+
+#parse a chunk of raw posts into its cached form: valid posts only (mentions>=1) and dates in UTC
+#slicing options (brands, groupby, timeframe) are applied after the cache so any run can reuse it
+def clean_posts(posts, date_format=None):
+    posts['mentions']=pd.to_numeric(posts['mentions'],errors='coerce')
+    posts=posts.loc[posts['mentions']>=1].copy()
+    posts['date']=parse_dates(posts['date'], date_format)
+    return posts
+
+# BRANDS
+#brand table (--brand-list, --brand-group) deduplicated and indexed by brand once: posts are joined to it by looking up
+#the few distinct brands of a chunk and taking the columns of the table by position, without merging or deduplicating the posts
+#a brand listed with different values still gets a row per value, as with a merge
+class BrandTable(object):
+    def __init__(self, table, key, columns):
+        super().__init__()
+        table=table[[key]+columns].drop_duplicates()
+        codes, keys = pd.factorize(table[key], use_na_sentinel=False)
+        #rows sorted by brand: brand i has counts[i] rows from starts[i], brands that are not in the table (-1) get no value
+        self.table=table.iloc[np.argsort(codes, kind='stable')].reset_index(drop=True)
+        self.keys=pd.Index(keys)
+        counts=np.bincount(codes, minlength=len(keys))
+        self.counts=np.append(counts, 1)
+        self.starts=np.append(np.cumsum(counts)-counts, -1)
+        self.columns=columns
+
+    #left join on the brand column of the posts, or with inner the posts of the brands in the table only
+    def join(self, posts, key, inner=False):
+        codes, brands = pd.factorize(posts[key], use_na_sentinel=False)
+        found=self.keys.get_indexer(brands)[codes]
+        if inner and (found<0).any():
+            posts=posts.loc[found>=0]
+            found=found[found>=0]
+        counts=self.counts[found]
+        positions=self.starts[found]
+        if (counts>1).any():
+            rows=np.repeat(np.arange(len(posts)), counts)
+            offsets=np.arange(len(rows))-np.repeat(np.cumsum(counts)-counts, counts)
+            positions=np.where(positions[rows]>=0, positions[rows]+offsets, -1)
+            posts=posts.iloc[rows]
+        if self.columns:
+            posts=posts.assign(**{c: pd.api.extensions.take(self.table[c].array, positions, allow_fill=True) for c in self.columns})
+        return posts
+
+#concatenate partial results, keeping categorical columns categorical across chunks
+#the categories are sorted by value, so that grouping on them gives the same order whatever the chunks and files
+def concat_chunks(frames):
+    frames=[f for f in frames if f is not None]
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            categories=pd.Index(np.concatenate([f[column].cat.categories.to_numpy(dtype=object) for f in frames])).unique().sort_values()
+            frames=[f.assign(**{column: f[column].cat.set_categories(categories)}) for f in frames]
+    return pd.concat(frames, ignore_index=True)
+
+#merge partial presence/performance results of several chunks
+def merge_presence(frames):
+    return concat_chunks(frames).drop_duplicates()
+
+#partial sums are summed again: one grouped sum over the observed categories only, sorted by influencer and brand
+def merge_perf(frames):
+    return concat_chunks(frames).groupby(columns_perf, sort=True, observed=True)[metrics].sum().reset_index()
 
 
 # RETENTION - ALL
-#get collumns of the retention table (columns of timeframe mainly)
-agg_all = pd.DataFrame(columns=table_all.columns)
-
-#aggregate mentions for all influencers by period
-agg_all.loc['Total'] = table_all.sum(numeric_only=True)
-
-#calculate nb of retained influencers
-def calculate_acquired_count(df, df_agg):
-    for i in df.columns:
-        x = df.columns.get_loc(i)
-        if x == 0:
-            y = 0
-        else:
-            y = df.loc[(df.iloc[:,x-1] == 0) & (df.iloc[:,x] == 1), i].count()
-        df_agg.loc['Acquired',i]=y
-    return df_agg
-
-#calculate nb of retained influencers
-def calculate_retained_count(df, df_agg):
-    for i in df.columns:
-        x = df.columns.get_loc(i)
-        if x == 0:
-            y = 0
-        else:
-            y = df.loc[(df.iloc[:,x-1] == 1) & (df.iloc[:,x] == 1), i].count()
-        df_agg.loc['Retained',i]=y
-    return df_agg
-
-#calculate nb of churned influencers
-def calculate_churned_count(df, df_agg):
-    for i in df.columns:
-        x = df.columns.get_loc(i)
-        if x == 0:
-            y = 0
-        else:
-            y = df.loc[(df.iloc[:,x-1] == 1) & (df.iloc[:,x] == 0), i].count()
-        df_agg.loc['Churned',i]=y
-    return df_agg
+#divide element-wise, 0 where the denominator is 0
+def safe_divide(numerator, denominator):
+    numerator=np.asarray(numerator, dtype=float)
+    denominator=np.asarray(denominator, dtype=float)
+    result=np.zeros(np.broadcast(numerator, denominator).shape)
+    np.divide(numerator, denominator, out=result, where=denominator!=0)
+    return result
+
+#count the rows active in each period (total) and in both the period and the one before it (retained)
+#presence is a sparse boolean matrix of rows (influencers, or group/influencer pairs) x periods, given by
+#the integer codes of its active cells; groups (0..ngroups-1, one per cell) split the counts by group
+#returns (groups x periods) totals and retained counts
+def count_presence(rows, periods, nperiods, groups=None, ngroups=1):
+    #flat cell index, sorted so that a row's periods follow each other
+    cells, first = np.unique(np.asarray(rows, dtype=np.int64)*nperiods+periods, return_index=True)
+    periods=cells%nperiods
+    groups=np.zeros(len(cells), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)[first]
+
+    total=np.bincount(groups*nperiods+periods, minlength=ngroups*nperiods)
+    #a cell following the cell of the previous period in the same row is retained
+    follows=np.flatnonzero(np.diff(cells)==1)+1
+    follows=follows[periods[follows]>0]
+    retained=np.bincount(groups[follows]*nperiods+periods[follows], minlength=ngroups*nperiods)
+    return total.reshape(ngroups, nperiods), retained.reshape(ngroups, nperiods)
+
+#derive acquired/retained/churned counts and the four rates for every pair of adjacent periods at once
+#total and retained are shaped (..., periods); the first period has nothing to compare with and stays at 0
+#acquired = active now but not before = total - retained
+#churned = active before but not now = previous total - retained
+def calculate_transitions(total, retained):
+    total=np.asarray(total, dtype=np.int64)
+    retained=np.asarray(retained, dtype=np.int64)
+    previous=np.zeros_like(total)
+    previous[...,1:]=total[...,:-1]
+
+    acquired=total-retained
+    #no period at all when no post is left after filtering
+    if total.shape[-1]:
+        acquired[...,0]=0
+    churned=previous-retained
+
+    counts=np.stack([total, acquired, retained, churned], axis=-2)
+    rates=np.stack([safe_divide(acquired, total),
+                    safe_divide(retained, previous),
+                    safe_divide(churned, previous),
+                    safe_divide(retained, total)], axis=-2)
+    return counts, rates
+
+#build the labelled retention table (counts as integers, rates as floats) from calculate_transitions output
+def retention_table(counts, rates, columns):
+    values=np.empty((len(COUNT_ROWS)+len(RATE_ROWS), len(columns)), dtype=object)
+    values[:len(COUNT_ROWS)]=counts
+    values[len(COUNT_ROWS):]=rates
+    return pd.DataFrame(values, index=COUNT_ROWS+RATE_ROWS, columns=columns)
 
 
-#calculate rates
-def calculate_acquisition_rate(df_agg):
-    for i in df_agg.columns:
-        x = df_agg.columns.get_loc(i)
-        if x <= 0:
-            y = 0
-        else:
+# RETENTION - GROUPBY
+#build the labelled retention table for groups: one block of rows per count/rate, with every group inside each block
+#keys holds the groupby values of each group
+def retention_table_group(keys, counts, rates, columns):
+    rows=COUNT_ROWS+RATE_ROWS
+    values=np.empty((len(rows), len(keys), len(columns)), dtype=object)
+    values[:len(COUNT_ROWS)]=counts.transpose(1, 0, 2)
+    values[len(COUNT_ROWS):]=rates.transpose(1, 0, 2)
+    table=pd.DataFrame(values.reshape(-1, len(columns)), columns=columns)
+    table=pd.concat([keys.iloc[np.tile(np.arange(len(keys)), len(rows))].reset_index(drop=True), table], axis=1)
+    return table.set_axis(np.repeat(rows, len(keys)))
+
+
+# PERIODS
+#label of a period code: months since year 0 divided by the number of months in the timeframe
+def period_label(code, timeframe):
+    months=TIMEFRAMES[timeframe]
+    year, month = divmod(code*months, 12)
+    n=month//months+1
+    if timeframe=='month':
+        return f'{year}-{n:02d}'
+    elif timeframe=='quarter':
+        return f'{year}-Q{n}'
+    elif timeframe=='half-year':
+        return f'{year}-H{n}'
+    return str(year)
+
+#roll the monthly presence rows up to the periods of a timeframe
+def rollup(presence, timeframe):
+    if timeframe=='month':
+        return presence
+    return presence.assign(period=presence['period']//TIMEFRAMES[timeframe]).drop_duplicates()
+
+#period codes (0..periods-1) of presence rows, with the label of each period
+def encode_periods(presence, timeframe):
+    codes, periods = pd.factorize(presence['period'], sort=True)
+    return codes, [period_label(p, timeframe) for p in periods]
+
+
+# KEYS
+#codes of values in keys, appending unseen values to the keys
+def encode(values, keys):
+    values=pd.Index(values)
+    codes=keys.get_indexer(values)
+    unseen=values[(codes==-1) & values.notna()].unique()
+    if len(unseen):
+        keys=keys.append(unseen)
+        codes=keys.get_indexer(values)
+    return codes, keys
+
+
+# OUTPUTS
+#acquired, retained and churned influencers and their rates, for all periods at once
+def retention_overall(presence, periods, labels):
+    total, retained = count_presence(presence['influencer'].to_numpy(), periods, len(labels))
+    agg_overall=retention_table(*calculate_transitions(total[0], retained[0]), labels)
+    return agg_overall.reset_index()
+
+#presence rows with a group, with the codes and labels of the periods they are active in
+def grouped_presence(presence, periods, labels):
+    grouped=presence['group'].to_numpy()>=0
+    used, periods = np.unique(periods[grouped], return_inverse=True)
+    return presence.loc[grouped], periods, [labels[i] for i in used]
+
+#divide metrics, no value when dividing by 0
+def ratio(numerator, denominator):
+    return numerator/denominator.where(denominator!=0)
+
+#for SAPMENA projects: keep retained_rate and acquisition_rate only, and rename retained_rate to retention_rate
+def sapmena(agg):
+    agg=agg.loc[~agg['index'].isin(['Retention_rate', 'Churn_rate'])].copy()
+    agg['index']=agg['index'].replace({'Retained_rate': 'Retention_rate'})
+    return agg
+
+
+# COHORTS
+#cohort of a row: the period it is first active in; counts the rows of each cohort active 0, 1, 2... periods after it
+#rows are influencers, or group/influencer pairs with the group (0..ngroups-1) of each presence row
+#periods are the periods of the timeframe themselves, not their codes, so that a period without posts still counts
+#returns the group, cohort period, offset and number of rows of every (group, cohort, offset) cell with rows
+def count_cohorts(rows, periods, groups=None):
+    periods=np.asarray(periods, dtype=np.int64)
+    start=periods.min()
+    span=periods.max()-start+1
+    #flat cell index, sorted so that a row's periods follow each other from its first one
+    cells, first = np.unique(np.asarray(rows, dtype=np.int64)*span+periods-start, return_index=True)
+    rows=cells//span
+    periods=cells%span
+    starts=np.flatnonzero(np.diff(rows, prepend=-1))
+    cohorts=np.repeat(periods[starts], np.diff(np.append(starts, len(cells))))
+    groups=np.zeros(len(cells), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)[first]
+
+    keys, counts = np.unique((groups*span+cohorts)*span+periods-cohorts, return_counts=True)
+    return keys//span//span, keys//span%span+start, keys%span, counts
+
+#cohort table: one row per group and cohort, with its size (Acquired) and the share of it active each period after
+#periods after the last period of the posts have no value; offsets are capped to max_offset periods
+def cohort_table(groups, cohorts, offsets, counts, timeframe, max_offset=None):
+    last=(cohorts+offsets).max()
+    noffsets=offsets.max()+1 if max_offset is None else min(offsets.max(), max_offset)+1
+    keep=offsets<noffsets
+    pairs, index = np.unique(groups*(last+1)+cohorts, return_inverse=True)
+    matrix=np.zeros((len(pairs), noffsets), dtype=np.int64)
+    matrix[index[keep], offsets[keep]]=counts[keep]
+
+    pair_cohorts=pairs%(last+1)
+    rates=matrix[:,1:]/matrix[:,:1]
+    rates[pair_cohorts[:,None]+np.arange(1, noffsets)>last]=np.nan
+    table=pd.DataFrame(rates, columns=[f'+{i}' for i in range(1, noffsets)])
+    table.insert(0, 'Acquired', matrix[:,0])
+    table.insert(0, 'cohort', [period_label(c, timeframe) for c in pair_cohorts])
+    return pairs//(last+1), table
+
+
+#engine of the files reduced in worker processes, inherited by the forked workers
+worker_engine=None
+
+#reduce a file in a worker process, sending the stages it timed back with its results
+def reduce_file_worker(f):
+    if worker_engine.profile is not None:
+        worker_engine.profile.clear()
+    presence, perf = worker_engine.reduce_file(f)
+    return presence, perf, dict(worker_engine.profile or {})
+
+
+#retention of the influencers of a set of posts, for any timeframe
+#the posts are loaded once (load) into presence rows by month, group and influencer, and run computes the outputs of a timeframe from them:
+#    engine=RetentionEngine(groupby=['category','group'], brand_group='taxonomy.csv')
+#    engine.load(posts)
+#    results=engine.run('quarter')
+#    results['all'], results['groupby']
+#brand_list and brand_group are CSV files or frames; posts is a frame, a post file, a folder of post files, a list of files or an s3:// folder
+#posts are counted in the months of timezone, their dates being read with date_format (strptime format, guessed by default)
+class RetentionEngine(object):
+    def __init__(self, groupby=None, brand_list=None, brand_group=None, group_fillna=False, sapmena=False, plm=False,
+                 chunksize=1000000, cache_dir=None, workers=1, s3_workers=8, start_date=None, end_date=None,
+                 timezone='US/Eastern', date_format=None, cohort_periods=None, profile=False, trace_memory=False):
+        super().__init__()
+        self.groupby=groupby.split(",") if isinstance(groupby, str) else list(groupby or [])
+        self.timezone=timezone
+        self.date_format=date_format
+        #number of periods after their first one the cohorts are followed for (all by default)
+        self.cohort_periods=cohort_periods
+        self.group_fillna=group_fillna
+        self.sapmena=sapmena
+        self.plm=plm
+        self.chunksize=chunksize
+        self.cache_dir=cache_dir
+        self.workers=workers
+        self.s3_workers=s3_workers
+        #day range of the S3 partitions to read
+        self.start_date=start_date
+        self.end_date=end_date
+
+        #--profile: wall time, CPU time, rows and peak memory by stage of the run
+        #stages running several times (by chunk, by file, by timeframe) add up; the peak RSS of a stage is the peak of the process so far
+        self.profile={} if profile or trace_memory else None
+        self.trace_memory=trace_memory
+        self.start=time.perf_counter()
+        self.start_cpu=time.process_time()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        #columns to read from the post files -- only what the selected outputs need
+        #post_uid keeps distinct posts apart when duplicated rows are dropped
+        self.columns_posts=['date','mentions','influencer_uid','post_uid']+self.groupby
+        if brand_list is not None or brand_group is not None:
+            self.columns_posts+=['group']
+        if plm:
+            self.columns_posts+=columns_perf+metrics
+
+        #subset of brands, with the columns of the outputs it may add to the posts
+        if isinstance(brand_list, str):
+            brand_list=pd.read_csv(brand_list, low_memory=False)
+        self.brands=None if brand_list is None else BrandTable(brand_list, 'group', [c for c in brand_list.columns if c!='group' and c in self.groupby+columns_perf])
+        #brand taxonomy -- optional
+        if isinstance(brand_group, str):
+            brand_group=pd.read_csv(brand_group, low_memory=False)
+        self.brand_group=None if brand_group is None else BrandTable(brand_group, 'brand_id', ['beauty_group'])
+
+        #ids and labels repeat over millions of rows, read them as categoricals
+        #(beauty_group is left out as it can be filled with "Competitor" later on)
+        self.dtypes={c:'category' for c in ['influencer_uid','post_uid','category','group','influencer_name','tiers']+self.groupby if c!='beauty_group'}
+
+        #size and ETag of each S3 file, from the listing
+        self.s3_objects={}
+        self.s3=None
+        self.s3_pid=None
+
+        self.presence_codes=None
+        self.perf=None
+
+    # PROFILE
+    def record(self, name, wall, cpu, rows):
+        entry=self.profile.setdefault(name, {'calls':0, 'rows':0, 'wall_s':0.0, 'cpu_s':0.0, 'peak_rss_mb':None, 'peak_traced_mb':None})
+        entry['calls']+=1
+        entry['rows']+=rows
+        entry['wall_s']+=wall
+        entry['cpu_s']+=cpu
+        peak=peak_rss_mb()
+        if peak is not None:
+            entry['peak_rss_mb']=max(entry['peak_rss_mb'] or 0, peak)
+        if self.trace_memory:
+            entry['peak_traced_mb']=max(entry['peak_traced_mb'] or 0, tracemalloc.get_traced_memory()[1]/1024/1024)
+
+    #time a stage of the run, rows being the rows it processes
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+        if self.profile is None:
+            yield
+            return
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        wall=time.perf_counter()
+        cpu=time.process_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter()-wall, time.process_time()-cpu, rows)
+
+    #time a stage producing chunks, rows being the rows of the chunks
+    def timed_chunks(self, name, chunks):
+        chunks=iter(chunks)
+        while True:
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+            wall=time.perf_counter()
+            cpu=time.process_time()
             try:
-                y = df_agg.iloc[1,x]/df_agg.iloc[0,x]
-            except:
-                y = 0
-        df_agg.loc['Acquisition_rate',i]=y
-    return df_agg
-
-def calculate_retention_rate(df_agg):
-    for i in df_agg.columns:
-        x = df_agg.columns.get_loc(i)
-        if x <= 0:
-            y = 0
-        else:
+                chunk=next(chunks)
+            except StopIteration:
+                return
+            if self.profile is not None:
+                self.record(name, time.perf_counter()-wall, time.process_time()-cpu, len(chunk))
+            yield chunk
+
+    #add the stages timed in a worker process
+    def merge_profile(self, stages):
+        for name, worker in stages.items():
+            entry=self.profile.setdefault(name, {'calls':0, 'rows':0, 'wall_s':0.0, 'cpu_s':0.0, 'peak_rss_mb':None, 'peak_traced_mb':None})
+            for column in ['calls','rows','wall_s','cpu_s']:
+                entry[column]+=worker[column]
+            if worker['peak_rss_mb'] is not None:
+                entry['peak_rss_mb']=max(entry['peak_rss_mb'] or 0, worker['peak_rss_mb'])
+            if worker['peak_traced_mb'] is not None:
+                entry['peak_traced_mb']=max(entry['peak_traced_mb'] or 0, worker['peak_traced_mb'])
+
+    #stage report, with the total since the engine was created
+    def profile_report(self):
+        self.record('total', time.perf_counter()-self.start, time.process_time()-self.start_cpu, 0)
+        total=self.profile.pop('total')
+        report=pd.DataFrame([{'stage':name, **entry} for name, entry in self.profile.items()]+[{'stage':'total', **total}])
+        report['rows_per_s']=(report['rows']/report['wall_s'].where(report['wall_s']>0)).where(report['rows']>0)
+        return report[PROFILE_COLUMNS]
+
+    # S3 SOURCE
+    #one S3 client per process (clients can't be shared with forked workers), boto3 is only needed with --s3
+    def s3_client(self):
+        if self.s3 is None or self.s3_pid!=os.getpid():
             try:
-                y = df_agg.iloc[2,x]/df_agg.iloc[0,x-1]
-            except:
-                y = 0
-        df_agg.loc['Retention_rate',i]=y
-    return df_agg
-
-def calculate_churn_rate(df_agg):
-    for i in df_agg.columns:
-        x = df_agg.columns.get_loc(i)
-        if x <= 0:
-            y = 0
+                import boto3
+                from botocore.config import Config
+            except ImportError:
+                raise RetentionError('reading posts from S3 needs boto3: pip install boto3')
+            self.s3=boto3.client('s3', config=Config(max_pool_connections=max(self.s3_workers, 10)))
+            self.s3_pid=os.getpid()
+        return self.s3
+
+    #partition folders (name=value/) directly under a prefix, with their value
+    def list_partitions(self, bucket, prefix, name):
+        for page in self.s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            for folder in page.get('CommonPrefixes', []):
+                value=folder['Prefix'][len(prefix):].rstrip('/')
+                if value.startswith(name+'=') and value[len(name)+1:].isdigit():
+                    yield int(value[len(name)+1:]), folder['Prefix']
+
+    #folders of the days between start and end, pruning the years and months out of the range before listing their days
+    def list_days(self, bucket, prefix, start, end):
+        start=start or datetime.min.date()
+        end=end or datetime.max.date()
+        for year, year_prefix in self.list_partitions(bucket, prefix, 'year'):
+            if not start.year<=year<=end.year:
+                continue
+            for month, month_prefix in self.list_partitions(bucket, year_prefix, 'month'):
+                if not (start.year, start.month)<=(year, month)<=(end.year, end.month):
+                    continue
+                for day, day_prefix in self.list_partitions(bucket, month_prefix, 'day'):
+                    try:
+                        if start<=datetime(year, month, day).date()<=end:
+                            yield day_prefix
+                    except ValueError:
+                        continue
+
+    #post files under an S3 folder, in the day partitions of the range when one is given
+    def list_s3_files(self, url, start, end):
+        bucket, prefix = split_s3_url(url.rstrip('/')+'/')
+        prefixes=self.list_days(bucket, prefix, start, end) if start or end else [prefix]
+        files=[]
+        for day_prefix in prefixes:
+            for page in self.s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=day_prefix):
+                for obj in page.get('Contents', []):
+                    #the metadata files of upload.py (metadata-{year}-{month}) are not posts
+                    if obj['Size']>0 and s3_suffix(obj['Key']) is not None and not any(part.startswith('metadata-') for part in obj['Key'][len(prefix):].split('/')):
+                        files.append(f"s3://{bucket}/{obj['Key']}")
+                        self.s3_objects[files[-1]]=(obj['Size'], obj['ETag'])
+        return files
+
+    #read a post file from S3 without writing it to disk, chunk by chunk and without holding the whole file:
+    #CSV files are streamed range after range, Parquet files are read by ranges of the columns needed
+    def read_s3_posts(self, url, chunksize):
+        bucket, key = split_s3_url(url)
+        size, etag = self.s3_objects[url]
+        suffix=s3_suffix(url)
+        if suffix=='.parquet':
+            import pyarrow.parquet as pq
+            with io.BufferedReader(S3RangeFile(self.s3_client(), bucket, key, size, etag), buffer_size=1024*1024) as data:
+                names=pq.ParquetFile(data).schema_arrow.names
+                columns=[c for c in names if c in self.columns_posts]
+                for batch in pq.ParquetFile(data, read_dictionary=[c for c in columns if c in self.dtypes]).iter_batches(batch_size=chunksize, columns=columns):
+                    yield batch.to_pandas()
         else:
-            try:
-                y = df_agg.iloc[3,x]/df_agg.iloc[0,x-1]
-            except:
-                y = 0
-        df_agg.loc['Churn_rate',i]=y
-    return df_agg
-        
-def calculate_retained_rate(df_agg):
-    for i in df_agg.columns:
-        x = df_agg.columns.get_loc(i)
-        if x <= 0:
-            y = 0
+            with io.BufferedReader(S3RangeStream(self.s3_client(), bucket, key, size, etag, self.s3_workers), buffer_size=S3_RANGE) as data:
+                yield from pd.read_csv(data, usecols=lambda c: c in self.columns_posts, dtype=self.dtypes, chunksize=chunksize, compression=S3_SUFFIXES[suffix], low_memory=False)
+
+    # POSTS
+    #post files of a file, a folder, a list of files or an S3 folder (pruned to the days between start_date and end_date)
+    def list_files(self, posts):
+        if not isinstance(posts, str):
+            files=list(posts)
+        elif posts.startswith('s3://'):
+            files=self.list_s3_files(posts, self.start_date, self.end_date)
+        elif os.path.isdir(posts):
+            #import multiple post files from a folder
+            files=glob.glob(posts+'/*.csv')
         else:
-            try:
-                y = df_agg.iloc[2,x]/df_agg.iloc[0,x]
-            except:
-                y = 0
-        df_agg.loc['Retained_rate',i]=y
-    return df_agg
-
-
-# RETENTION - GROUPBY
-data = table_groupby.copy()
-# Calculate totals by brand
-total_groupby = pd.DataFrame(columns=data.columns)
-total_groupby = data.groupby('combined', as_index=True).sum()
-total_groupby.reset_index(inplace=True)
-total_groupby.index=['Total']*len(total_groupby)
-
-# calculate nb of influencers by group
-
-def calculate_acquired_count_group(groupby):
-    gp = data.groupby(groupby)
-    acquired = pd.DataFrame(columns=total_groupby.columns)
-
-    for key, group in gp:
-        for i in group.columns:
-            x = group.columns.get_loc(i)
-            if x == 0:
-                y = key
-            else:
-                y = group.loc[(group.iloc[:,x-1] == 0) & (group.iloc[:,x] == 1), i].count()
-            acquired.loc[key,i]=y
-        acquired.index.values[:]='Acquired'
-        acquired = acquired.drop('influencer_uid', axis=1)
-    return acquired
-
-def calculate_retained_count_group(groupby):
-    gp = data.groupby(groupby)
-    retained = pd.DataFrame(columns=total_groupby.columns)
-
-    for key, group in gp:
-        for i in group.columns:
-            x = group.columns.get_loc(i)
-            if x == 0:
-                y = key
-            else:
-                y = group.loc[(group.iloc[:,x-1] == 1) & (group.iloc[:,x] == 1), i].count()
-            retained.loc[key,i]=y
-        retained.index.values[:]='Retained'
-        retained = retained.drop('influencer_uid', axis=1)
-    return retained
-
-def calculate_churned_count_group(groupby):
-    gp = data.groupby(groupby)
-    churned = pd.DataFrame(columns=total_groupby.columns)
-
-    for key, group in gp:
-        for i in group.columns:
-            x = group.columns.get_loc(i)
-            if x == 0:
-                y = key
-            else:
-                y = group.loc[(group.iloc[:,x-1] == 1) & (group.iloc[:,x] == 0), i].count()
-            churned.loc[key,i]=y
-        churned.index.values[:]='Churned'
-        churned = churned.drop('influencer_uid', axis=1)
-    return churned
-
-
-#calculate rates
-
-def calculate_acquisition_rate_group(groupby):
-    gp_rate = agg_count_groupby.groupby(groupby)
-    acquisition_rate = pd.DataFrame(columns=agg_count_groupby.columns)
-    
-    for key, group in gp_rate:
-        for i in group.columns:
-            x = group.columns.get_loc(i)
-            if x == 0:
-                y = key
-            else:
-                try:
-                    y = group.iloc[1,x]/group.iloc[0,x]
-                except:
-                    y = 0
-            acquisition_rate.loc[key,i]=y
-        acquisition_rate.index.values[:]='Acquisition_rate'
-    return acquisition_rate
-
-def calculate_retention_rate_group(groupby):
-    gp_rate = agg_count_groupby.groupby(groupby)
-    retention_rate = pd.DataFrame(columns=agg_count_groupby.columns)
-    
-    for key, group in gp_rate:
-        for i in group.columns:
-            x = group.columns.get_loc(i)
-            if x == 0:
-                y = key
+            files=[posts]
+        if not files:
+            raise RetentionError(f'No post files found in {posts}')
+        return files
+
+    #read the post files chunk by chunk, keeping the needed columns only
+    def read_posts(self, files, chunksize):
+        for f in files:
+            if f.startswith('s3://'):
+                yield from self.read_s3_posts(f, chunksize)
+            elif self.cache_dir:
+                yield from self.read_cached_posts(f, chunksize)
             else:
+                reader=pd.read_csv(f, usecols=lambda c: c in self.columns_posts, dtype=self.dtypes, chunksize=chunksize, low_memory=False)
+                for chunk in reader:
+                    yield chunk
+
+    #chunks of a frame of posts already loaded, with the needed columns typed as when read from the files
+    def frame_chunks(self, posts, chunksize):
+        columns=[c for c in posts.columns if c in self.columns_posts]
+        for start in range(0, len(posts), chunksize):
+            chunk=posts.iloc[start:start+chunksize][columns]
+            yield chunk.astype({c:'category' for c in columns if c in self.dtypes})
+
+    #cache entry of a post file: one folder of Parquet parts per path, keyed by the file size and mtime and the parse options
+    def cache_entry(self, f):
+        stat=os.stat(f)
+        source=hashlib.sha1(os.path.abspath(f).encode()).hexdigest()
+        version=hashlib.sha1(f'{stat.st_size}:{stat.st_mtime_ns}:{self.date_format}'.encode()).hexdigest()[:16]
+        return source, os.path.join(self.cache_dir, source+'-'+version)
+
+    #parse a post file once into Parquet parts (one per chunk), replacing older entries of the same file
+    #all the columns are cached for any later --groupby: the ones that can be ids or labels are read as categoricals,
+    #as self.dtypes reads them without the cache, so numeric-looking values stay strings
+    def build_cache(self, f, entry, source, chunksize):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        building=tempfile.mkdtemp(dir=self.cache_dir, prefix='.building-')
+        dtypes={c:'category' for c in pd.read_csv(f, nrows=0).columns if c not in ['date','beauty_group','audience_size']+metrics}
+        for i, chunk in enumerate(pd.read_csv(f, dtype=dtypes, chunksize=chunksize, low_memory=False)):
+            pq.write_table(pa.Table.from_pandas(clean_posts(chunk, self.date_format), preserve_index=False), os.path.join(building, f'part-{i:05d}.parquet'))
+
+        for stale in glob.glob(os.path.join(self.cache_dir, source+'-*')):
+            shutil.rmtree(stale, ignore_errors=True)
+        try:
+            os.rename(building, entry)
+        except OSError:
+            #another run cached the same file in the meantime
+            shutil.rmtree(building, ignore_errors=True)
+
+    #read a post file from the cache (building it on the first run), memory-mapping the needed columns only
+    def read_cached_posts(self, f, chunksize):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RetentionError('caching post files needs pyarrow: pip install pyarrow')
+
+        source, entry = self.cache_entry(f)
+        if not os.path.isdir(entry):
+            self.build_cache(f, entry, source, chunksize)
+
+        for part in sorted(glob.glob(os.path.join(entry, 'part-*.parquet'))):
+            names=pq.read_schema(part).names
+            columns=[c for c in names if c in self.columns_posts]
+            table=pq.read_table(part, columns=columns, memory_map=True, read_dictionary=[c for c in columns if c in self.dtypes])
+            yield table.to_pandas()
+
+    #filter and enrich a chunk of posts: brand subset and taxonomy, valid posts, month
+    def prepare_posts(self, posts):
+        if self.brands is not None:
+            with self.stage('brand_list', len(posts)):
+                posts=self.brands.join(posts, 'group', inner=True)
+
+        if self.brand_group is not None:
+            with self.stage('brand_group', len(posts)):
+                #left outer join and add tiers for posts
+                posts=self.brand_group.join(posts, 'group')
+
+        with self.stage('valid_posts', len(posts)):
+            #include valid posts only (mentions>=1)
+            posts=posts.assign(mentions=pd.to_numeric(posts['mentions'],errors='coerce'))
+            posts=posts.loc[posts['mentions']>=1].copy()
+
+        with self.stage('dates', len(posts)):
+            #index the posts by month (months since year 0), coarser timeframes are rolled up from it
+            period=month_codes(parse_dates(posts['date'], self.date_format), self.timezone)
+            posts=posts.loc[period>=0].assign(period=period[period>=0])
+
+        #fillna for beauty_group with "Competitor" -- if loreal only
+        if self.group_fillna:
+            posts.fillna({'beauty_group':'Competitor'}, inplace=True)
+
+        return posts
+
+    #reduce a chunk of posts to the influencers active by month and group (0/1 presence)
+    #and, for --out-plm, to the metrics summed by influencer and brand
+    def reduce_posts(self, posts):
+        with self.stage('presence', len(posts)):
+            presence=posts[['period']+self.groupby+['influencer_uid']].drop_duplicates()
+        if self.plm:
+            with self.stage('plm_sums', len(posts)):
+                perf=posts.groupby(columns_perf, sort=False, observed=True)[metrics].sum().reset_index()
+        else:
+            perf=None
+        return presence, perf
+
+    #merge (presence, perf) partial results as they come in, compacting every few of them to keep memory flat
+    def merge_results(self, results):
+        presence_parts=[]
+        perf_parts=[]
+        for presence, perf in results:
+            presence_parts.append(presence)
+            perf_parts.append(perf)
+            if len(presence_parts)>=16:
+                with self.stage('merge', sum(len(part) for part in presence_parts)):
+                    presence_parts=[merge_presence(presence_parts)]
+                    if self.plm:
+                        perf_parts=[merge_perf(perf_parts)]
+
+        with self.stage('merge', sum(len(part) for part in presence_parts)):
+            presence=merge_presence(presence_parts)
+            perf=merge_perf(perf_parts) if self.plm else None
+        return presence, perf
+
+    #filter and reduce chunks of posts
+    def reduce_chunks(self, chunks):
+        return self.merge_results(self.reduce_posts(self.prepare_posts(chunk)) for chunk in self.timed_chunks('load', chunks))
+
+    #read, filter and reduce one post file, streaming it chunk by chunk
+    def reduce_file(self, f):
+        return self.reduce_chunks(self.read_posts([f], self.chunksize))
+
+    def merge_worker_results(self, results):
+        for presence, perf, stages in results:
+            if self.profile is not None:
+                self.merge_profile(stages)
+            yield presence, perf
+
+    #load the posts into presence rows by month, group and influencer (and performance sums with plm)
+    #a frame is reduced chunk by chunk as it is, files are each reduced on their own (in parallel with workers) and the partial results are merged
+    def load(self, posts):
+        global worker_engine
+        if isinstance(posts, pd.DataFrame):
+            presence, self.perf = self.reduce_chunks(self.frame_chunks(posts, self.chunksize))
+        else:
+            files=self.list_files(posts)
+            if self.workers>1 and len(files)>1:
+                #workers are forked: they get the engine as it is, with its brand tables, without pickling it
+                worker_engine=self
                 try:
-                    y = group.iloc[2,x]/group.iloc[0,x-1]
-                except:
-                    y = 0
-            retention_rate.loc[key,i]=y
-        retention_rate.index.values[:]='Retention_rate'
-    return retention_rate
-
-def calculate_churn_rate_group(groupby):
-    gp_rate = agg_count_groupby.groupby(groupby)
-    churn_rate = pd.DataFrame(columns=agg_count_groupby.columns)
-    
-    for key, group in gp_rate:
-        for i in group.columns:
-            x = group.columns.get_loc(i)
-            if x == 0:
-                y = key
+                    with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                        presence, self.perf = self.merge_results(self.merge_worker_results(pool.map(reduce_file_worker, files)))
+                finally:
+                    worker_engine=None
             else:
-                try:
-                    y = group.iloc[3,x]/group.iloc[0,x-1]
-                except:
-                    y = 0
-            churn_rate.loc[key,i]=y
-        churn_rate.index.values[:]='Churn_rate'
-    return churn_rate
-
-def calculate_retained_rate_group(groupby):
-    gp_rate = agg_count_groupby.groupby(groupby)
-    retained_rate = pd.DataFrame(columns=agg_count_groupby.columns)
-    
-    for key, group in gp_rate:
-        for i in group.columns:
-            x = group.columns.get_loc(i)
-            if x == 0:
-                y = key
+                presence, self.perf = self.merge_results(self.reduce_file(f) for f in files)
+
+        #factorize the presence rows once: influencers and groups become integer codes
+        with self.stage('keys', len(presence)):
+            influencer_codes, influencer_keys = pd.factorize(presence['influencer_uid'])
+            self.influencer_keys=pd.Index(influencer_keys)
+            if self.groupby:
+                group_codes, self.group_keys = self.factorize_groups(presence)
             else:
-                try:
-                    y = group.iloc[2,x]/group.iloc[0,x]
-                except:
-                    y = 0
-            retained_rate.loc[key,i]=y
-        retained_rate.index.values[:]='Retained_rate'
-    return retained_rate
-
-
-if args.out_all:
-    #aggregate mentions for acquired, retained and churned influencers
-    calculate_acquired_count(table_all,agg_all)
-    calculate_retained_count(table_all,agg_all)
-    agg_count_overall = calculate_churned_count(table_all,agg_all)
-
-    calculate_acquisition_rate(agg_all)
-    calculate_retention_rate(agg_all)
-    calculate_churn_rate(agg_all)
-    agg_overall = calculate_retained_rate(agg_all)
-    agg_overall = agg_overall.drop('influencer_uid',axis=1).reset_index()
-else:
-    pass
-
-if args.out_groupby:
-    #calculate count
-    agg_count_groupby = total_groupby.append([calculate_acquired_count_group('combined'),
-                                            calculate_retained_count_group('combined'),
-                                            calculate_churned_count_group('combined')])
-
-    #calculate rates
-    agg_rate_groupby = calculate_acquisition_rate_group('combined').append([calculate_retention_rate_group('combined'),
-                                                                            calculate_churn_rate_group('combined'),
-                                                                            calculate_retained_rate_group('combined')])
-    agg_groupby = agg_count_groupby.append(agg_rate_groupby)
-
-
-    #get the columns for the agg table
-    columns_agg_groupby=groupby+agg_groupby.drop('combined', axis=1).columns.values.tolist()
-
-    #split the combined column
-    agg_groupby[groupby] = agg_groupby['combined'].str.split('_', expand=True)
-    agg_groupby.drop('combined', axis=1)
-
-    #re-order
-    agg_groupby=agg_groupby.loc[:,columns_agg_groupby].reset_index()
-else:
-    pass
-
-
-
-if args.out_plm:
-    # Add social performance -- optional
-    metrics=['mentions','total_engagements','video_views','reach_for_eng','reach_for_vv']
-
-    #aggregate performance metrics by brand and by influencer with pivot_table
-    #beauty_group is optional
-    perf=pd.pivot_table(posts, index=['category','group','beauty_group','influencer_uid','influencer_name','tiers','audience_size'], 
-                    values=metrics, 
-                    aggfunc=np.sum).reset_index()
-
-    #calculate extra metrics
-    perf['total_influence']=perf['total_engagements']+perf['video_views']
-    perf['eng_rate']=perf['total_engagements']/perf['reach_for_eng']
-    perf['eng/vv']=perf['total_engagements']/perf['video_views']
-    perf['frequency']=perf['mentions']/1
-    perf['total_influence per mention']=perf['total_influence']/perf['mentions']
-
-    #replace all of the inf values with na
-    perf = perf.replace([np.inf, -np.inf], np.nan)
-
-    #re-order columns
-    columns=['category', 'group', 'beauty_group', 'influencer_uid', 'influencer_name', 'tiers',
-            'audience_size', 'mentions', 'frequency','eng_rate','total_engagements', 
-            'video_views', 'eng/vv', 'total_influence','total_influence per mention']
-    perf=perf.loc[:,columns]
-
-    portfolio = table_groupby.copy()
-
-    #get the columns for the agg table
-    columns_portfolio=groupby+table_groupby.drop('combined', axis=1).columns.values.tolist()
-
-    #create portfolio - mentions by influencer and brand, by period
-    portfolio[groupby] = portfolio['combined'].str.split('_', expand=True)
-
-    #re-order
-    portfolio = portfolio.loc[:,columns_portfolio]
-
-    #merge performance metrics with portfolio
-    plm=perf.merge(portfolio, on=groupby+['influencer_uid'], how='left')
-    plm=plm.loc[plm['category']!='all']
-else:
-    pass
-
-
-if args.sapmena:
-    if args.out_all:
-        #keep retained_rate and acquisition_rate only
-        agg_overall=agg_overall.loc[~agg_overall['index'].isin(['Retention_rate', 'Churn_rate'])]
-        #rename retained_rate to retention_rate
-        agg_overall['index']=agg_overall['index'].replace({'Retained_rate': 'Retention_rate'})
-    else:
-        pass
-
-    if args.out_groupby:
-        agg_groupby=agg_groupby.loc[~agg_groupby['index'].isin(['Retention_rate', 'Churn_rate'])]
-        agg_groupby['index']=agg_groupby['index'].replace({'Retained_rate': 'Retention_rate'})
+                group_codes, self.group_keys = -1, pd.DataFrame()
+            self.presence_codes=pd.DataFrame({'period': presence['period'].to_numpy(), 'group': group_codes, 'influencer': influencer_codes})
+        return self
+
+    # KEYS
+    #presence rows hold integer codes: influencer_keys and group_keys are the values behind them
+    #group_keys is a frame of groupby values, one row per group code (sorted); rows without a group get -1
+
+    #composite group key: one integer code per combination of groupby values, sorted, without building strings
+    #as with a single filter before, a missing value leaves the row without group (-1), while a combination keeps its missing parts
+    #categoricals sort by code, in the order their categories were read: they are sorted by value first
+    def factorize_groups(self, presence):
+        presence=presence[self.groupby].assign(**{c: presence[c].cat.reorder_categories(presence[c].cat.categories.sort_values())
+                                                  for c in self.groupby if isinstance(presence[c].dtype, pd.CategoricalDtype)})
+        grouper=presence.groupby(self.groupby, sort=True, dropna=len(self.groupby)==1, observed=True)
+        codes=grouper.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        return codes, grouper.size().index.to_frame(index=False)
+
+    #group codes of groupby values with the current keys, appending unseen combinations to the keys
+    def encode_groups(self, values):
+        values=values[self.groupby].reset_index(drop=True)
+        codes=self.lookup_groups(values)
+        unseen=values.loc[codes==-1].drop_duplicates()
+        if len(self.groupby)==1:
+            unseen=unseen.dropna()
+        if len(unseen):
+            self.group_keys=pd.concat([self.group_keys, unseen], ignore_index=True)
+            codes=self.lookup_groups(values)
+        return codes
+
+    #group codes of groupby values, -1 for combinations that are not in the keys
+    def lookup_groups(self, values):
+        codes=values[self.groupby].merge(self.group_keys.assign(_code=np.arange(len(self.group_keys))), on=self.groupby, how='left')['_code']
+        return codes.fillna(-1).to_numpy(dtype=np.int64)
+
+    #groupby values of group codes
+    def decode_groups(self, codes):
+        return self.group_keys.reindex(codes).reset_index(drop=True)
+
+    #original values of coded presence rows
+    def decode_presence(self, presence):
+        decoded=presence[['period']].reset_index(drop=True)
+        if self.groupby:
+            decoded=pd.concat([decoded, self.decode_groups(presence['group'].to_numpy())], axis=1)
+        decoded['influencer_uid']=self.influencer_keys.take(presence['influencer'].to_numpy())
+        return decoded
+
+    #code presence rows with the current keys, adding unseen influencers and groups
+    def encode_presence(self, presence):
+        coded=pd.DataFrame({'period': presence['period'].to_numpy()})
+        if self.groupby:
+            coded['group']=self.encode_groups(presence)
+        else:
+            coded['group']=-1
+        coded['influencer'], self.influencer_keys = encode(presence['influencer_uid'], self.influencer_keys)
+        return coded
+
+    # OUTPUTS
+    #counts and rates for all groups and periods at once, each group/influencer pair being a row of the presence matrix
+    def retention_groupby(self, presence, periods, labels):
+        presence, periods, labels = grouped_presence(presence, periods, labels)
+        groups=presence['group'].to_numpy()
+        rows=groups*len(self.influencer_keys)+presence['influencer'].to_numpy()
+        total, retained = count_presence(rows, periods, len(labels), groups, len(self.group_keys))
+
+        #groups with no influencer in this timeframe are left out
+        present=np.flatnonzero(total.sum(axis=1)>0)
+        if not len(labels) or not len(present):
+            return pd.DataFrame(columns=['index']+self.groupby)
+        counts, rates = calculate_transitions(total[present], retained[present])
+        agg_groupby=retention_table_group(self.decode_groups(present), counts, rates, labels)
+        return agg_groupby.reset_index()
+
+    #0/1 matrix of the periods each group/influencer pair is active in, with the sorted pair codes of its rows
+    def portfolio_table(self, presence, periods, labels):
+        presence, periods, labels = grouped_presence(presence, periods, labels)
+        pairs, rows = np.unique(presence['group'].to_numpy().astype(np.int64)*len(self.influencer_keys)+presence['influencer'].to_numpy(), return_inverse=True)
+        matrix=np.zeros((len(pairs), len(labels)), dtype=np.int64)
+        matrix[rows, periods]=1
+        return pairs, matrix, labels
+
+    #group/influencer pair codes of the rows of a frame, -1 for pairs that are not in the keys
+    def pair_codes(self, frame):
+        #the few distinct groupby combinations are looked up, not every row
+        grouper=frame.groupby(self.groupby, sort=False, dropna=False, observed=True)
+        groups=self.lookup_groups(grouper.size().index.to_frame(index=False))[grouper.ngroup().to_numpy()]
+        influencers=self.influencer_keys.get_indexer(frame['influencer_uid'])
+        return np.where((groups>=0) & (influencers>=0), groups*len(self.influencer_keys)+influencers, -1)
+
+    #influencer list with performance metrics, with the portfolio of brands mentioned by period
+    def performance(self, presence, periods, labels):
+        # Add social performance -- optional
+        #perf: metrics summed by brand and by influencer while streaming the posts
+        #beauty_group is optional
+        perf=self.perf.loc[self.perf['category']!='all'].reset_index(drop=True)
+
+        #calculate extra metrics
+        perf['total_influence']=perf['total_engagements']+perf['video_views']
+        perf['eng_rate']=ratio(perf['total_engagements'], perf['reach_for_eng'])
+        perf['eng/vv']=ratio(perf['total_engagements'], perf['video_views'])
+        perf['frequency']=perf['mentions']/1
+        perf['total_influence per mention']=ratio(perf['total_influence'], perf['mentions'])
+
+        #re-order columns
+        columns=['category', 'group', 'beauty_group', 'influencer_uid', 'influencer_name', 'tiers',
+                'audience_size', 'mentions', 'frequency','eng_rate','total_engagements',
+                'video_views', 'eng/vv', 'total_influence','total_influence per mention']
+        perf=perf.loc[:,columns]
+
+        #join the portfolio - mentions by influencer and brand, by period - on the group/influencer codes
+        pairs, matrix, labels = self.portfolio_table(presence, periods, labels)
+        rows=self.pair_codes(perf)
+        position=np.minimum(np.searchsorted(pairs, rows), max(len(pairs)-1, 0))
+        found=(rows>=0) & (pairs[position]==rows) if len(pairs) else np.zeros(len(rows), dtype=bool)
+        portfolio=pd.DataFrame(matrix[position] if len(pairs) else np.zeros((len(rows), len(labels))), columns=labels)
+        if not found.all():
+            portfolio=portfolio.where(np.broadcast_to(found[:,None], portfolio.shape))
+        return pd.concat([perf, portfolio], axis=1)
+
+    #share of the influencers first active in each period (cohort) that are active 1, 2... periods later, overall or by group
+    #with groups, an influencer joins the cohort of a group the first period it is active in that group
+    def cohorts(self, presence, timeframe, grouped=False):
+        keys=self.groupby if grouped else []
+        if grouped:
+            presence=presence.loc[presence['group'].to_numpy()>=0]
+        if presence.empty:
+            return pd.DataFrame(columns=keys+['cohort','Acquired'])
+        if grouped:
+            groups=presence['group'].to_numpy()
+            rows=groups*len(self.influencer_keys)+presence['influencer'].to_numpy()
+            group_codes, table = cohort_table(*count_cohorts(rows, presence['period'].to_numpy(), groups), timeframe, self.cohort_periods)
+            return pd.concat([self.decode_groups(group_codes), table], axis=1)
+        _, table = cohort_table(*count_cohorts(presence['influencer'].to_numpy(), presence['period'].to_numpy()), timeframe, self.cohort_periods)
+        return table
+
+    # INCREMENTAL UPDATES
+    #presence rows of the last two periods of each timeframe, read back from a state file
+    #ids and labels are read as strings as in the posts, numeric-looking uids would not match them otherwise
+    def read_state(self, path):
+        state=pd.read_csv(path, dtype={c:str for c in self.dtypes})
+        if list(state.columns)!=['timeframe','period']+self.groupby+['influencer_uid']:
+            raise RetentionError(f'{path} was saved with other --groupby columns')
+        return state
+
+    #save the 'state' outputs of run, sorted by group and influencer
+    def save_state(self, states, path):
+        columns=['timeframe','period']+self.groupby+['influencer_uid']
+        state=pd.concat(states, ignore_index=True)[columns].sort_values(columns)
+        state.to_csv(path, index=False)
+
+    def last_periods(self, presence, timeframe):
+        periods=np.sort(presence['period'].unique())[-2:]
+        return self.decode_presence(presence.loc[presence['period'].isin(periods)]).assign(timeframe=timeframe)
+
+    #add the saved last periods of a timeframe to the coded presence rows of the new posts
+    #returns the rows and the label of the saved period the new ones are compared with (already in the outputs)
+    def extend_state(self, presence, timeframe, state):
+        saved=state.loc[state['timeframe']==timeframe].drop(columns='timeframe')
+        if saved.empty:
+            raise RetentionError(f'the state has no {timeframe} periods, run once without --incremental first')
+        periods=np.sort(saved['period'].unique())
+        if (presence['period']<periods[-1]).any():
+            raise RetentionError(f'the posts go back before {period_label(periods[-1], timeframe)}, which is already in the state')
+
+        if (presence['period']==periods[-1]).any():
+            #the last saved period gets more posts: it is computed again against the one before
+            base=periods[-2] if len(periods)>1 else None
+        else:
+            base=periods[-1]
+        if base is not None:
+            saved=saved.loc[saved['period']>=base]
+
+        presence=pd.concat([self.encode_presence(saved), presence], ignore_index=True).drop_duplicates()
+        return presence, None if base is None else period_label(base, timeframe)
+
+    #outputs of a timeframe ('all', 'groupby', 'plm', 'cohort', 'cohort_groupby' and 'state', all those available by default), every timeframe being rolled up from the same monthly presence rows
+    #with a state (read_state), the saved last periods are added to the new posts, and 'base' is the label of the saved period they are compared with
+    def run(self, timeframe, outputs=None, state=None):
+        if timeframe not in TIMEFRAMES:
+            raise ValueError(f'unknown timeframe {timeframe}, expected month|quarter|half-year|year')
+        if self.presence_codes is None:
+            raise RetentionError('no posts loaded, call load first')
+        if outputs is None:
+            outputs=[output for output in OUTPUTS if output!='plm' or self.plm]
+        if 'plm' in outputs and not self.plm:
+            raise RetentionError('the plm output needs an engine created with plm=True')
+        for output in ['plm','cohort','cohort_groupby']:
+            if output in outputs and state is not None:
+                raise RetentionError(f'the {output} output needs the full history and cannot be computed with a state')
+
+        results={}
+        with self.stage('periods', len(self.presence_codes)):
+            presence=rollup(self.presence_codes, timeframe)
+            if state is not None:
+                presence, results['base'] = self.extend_state(presence, timeframe, state)
+            periods, labels = encode_periods(presence, timeframe)
+
+        if 'all' in outputs:
+            with self.stage('retention_all', len(presence)):
+                results['all']=retention_overall(presence, periods, labels)
+                if self.sapmena:
+                    results['all']=sapmena(results['all'])
+
+        if 'groupby' in outputs:
+            with self.stage('retention_groupby', len(presence)):
+                results['groupby']=self.retention_groupby(presence, periods, labels)
+                if self.sapmena:
+                    results['groupby']=sapmena(results['groupby'])
+
+        if 'plm' in outputs:
+            with self.stage('plm', len(self.perf)):
+                results['plm']=self.performance(presence, periods, labels)
+
+        if 'cohort' in outputs:
+            with self.stage('cohort', len(presence)):
+                results['cohort']=self.cohorts(presence, timeframe)
+
+        if 'cohort_groupby' in outputs:
+            with self.stage('cohort_groupby', len(presence)):
+                results['cohort_groupby']=self.cohorts(presence, timeframe, grouped=True)
+
+        if 'state' in outputs:
+            results['state']=self.last_periods(presence, timeframe)
+        return results
+
+
+#merge the new periods of a retention output into the existing table, keeping counts as integers and rates as floats
+def update_output(existing, table, keys):
+    keys=['index']+keys
+    periods=table.columns.drop(keys)
+    table[keys]=table[keys].astype(object).fillna('').astype(str)
+    existing=existing.drop(columns=[c for c in periods if c in existing.columns])
+
+    order={label: i for i, label in enumerate(pd.unique(pd.concat([existing['index'], table['index']])))}
+    table=existing.merge(table, on=keys, how='outer', sort=False)
+    table=table.sort_values(keys, key=lambda s: s.map(order) if s.name=='index' else s, kind='stable')
+
+    #groups missing from either side had no influencers in those periods
+    counts=table['index'].isin(COUNT_ROWS).to_numpy()
+    for c in table.columns.drop(keys):
+        values=table[c].replace('', np.nan).astype(float).fillna(0).to_numpy()
+        column=values.astype(object)
+        column[counts]=values[counts].astype(np.int64)
+        table[c]=column
+    return table
+
+#write an output, or with --incremental update the existing file with the new periods
+def write_output(table, path, keys, base, incremental=False):
+    if incremental and os.path.exists(path):
+        if base is not None:
+            table=table.drop(columns=base, errors='ignore')
+        table=update_output(pd.read_csv(path, dtype=str, keep_default_na=False), table, keys)
+    table.to_csv(path, index=False, quoting=csv.QUOTE_NONNUMERIC)
+
+#output file of a timeframe: suffixed with the timeframe when several are computed in one run
+def output_path(path, timeframe, timeframes):
+    if len(timeframes)==1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}_{timeframe}{ext}'
+
+def write_profile(report, path):
+    if path=='-':
+        print(report.to_string(index=False, float_format=lambda x: f'{x:.3f}'))
+    elif path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(json.loads(report.to_json(orient='records')), f, indent=2)
     else:
-        pass
-else:
-    pass
-
-
-if args.out_all:
-    OUT_ALL=args.out_all
-    agg_overall.to_csv(OUT_ALL, index=False, quoting=csv.QUOTE_NONNUMERIC)
-else:
-    pass
-
-
-if args.out_groupby:
-    OUT_GROUPBY=args.out_groupby
-    agg_groupby.to_csv(OUT_GROUPBY, index=False, quoting=csv.QUOTE_NONNUMERIC)
-else:
-    pass
-
-
-if args.out_plm:
-    OUT_PLM=args.out_plm
-    plm.to_csv(OUT_PLM, index=False, quoting=csv.QUOTE_NONNUMERIC)
-else:
-    pass
-
-
-print("Done!")
\ No newline at end of file
+        report.to_csv(path, index=False, quoting=csv.QUOTE_NONNUMERIC)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Scripts to calculate retention rate over periods")
+    parser.add_argument('-p','--posts', help='Single post file from an IMB (export folder))')
+    parser.add_argument('-f','--folder', help='Folder of multiple post files from IMBs (export folder)')
+    parser.add_argument('--s3', help='S3 folder of post files uploaded by upload.py (s3://bucket/folder), read without copying them to disk (needs boto3)')
+    parser.add_argument('--start-date', help='With --s3, first day (YYYY-MM-DD) of the year=/month=/day= folders to read')
+    parser.add_argument('--end-date', help='With --s3, last day (YYYY-MM-DD) of the year=/month=/day= folders to read')
+    parser.add_argument('--s3-workers', help='Number of concurrent ranged downloads of each S3 file (default: 8)', type=int, default=8)
+    parser.add_argument('-g','--groupby', help='Filters to partition the data')
+    parser.add_argument('-t','--timeframe', help='Set the timeframe for the aggregation. month|quarter|half-year|year, several separated by commas, or all',required=True)
+    parser.add_argument('--brand-list', help='CSV file of a subset of brands')
+    parser.add_argument('--brand-group', help='CSV file of taxonomy of brands')
+    parser.add_argument('--group-fillna', help='Fill NAs with Competitor - for loreal only',action='store_true')
+    parser.add_argument('--sapmena', help='For SAPMENA projects only - change retained rate to retention rate per request',action='store_true')
+    parser.add_argument('--out-all', help='Output the overall retention rates')
+    parser.add_argument('--out-groupby', help='Output the retention rates for groupby items')
+    parser.add_argument('--out-plm', help='Output the influencer list with performance metrics for groupby items')
+    parser.add_argument('--out-cohort', help='Output the share of the influencers first active in each period still active 1, 2... periods later')
+    parser.add_argument('--out-cohort-groupby', help='Output the cohorts of each groupby item')
+    parser.add_argument('--cohort-periods', help='Number of periods after their first one the cohorts are followed for (default: all)', type=int)
+    parser.add_argument('--timezone', help='Timezone of the months the posts are counted in (default: US/Eastern)', default='US/Eastern')
+    parser.add_argument('--date-format', help='strptime format of the post dates, e.g. %%Y-%%m-%%dT%%H:%%M:%%S%%z (default: guessed from the first dates)')
+    parser.add_argument('--chunksize', help='Number of post rows read at a time (default: 1000000)', type=int, default=1000000)
+    parser.add_argument('--cache-dir', help='Folder caching the parsed post files as Parquet, reused while the files are unchanged (needs pyarrow)')
+    parser.add_argument('--workers', help='Number of processes loading the post files of --folder in parallel (default: 1)', type=int, default=1)
+    parser.add_argument('--state', help='CSV file keeping the influencers active in the last periods, to add new periods later with --incremental')
+    parser.add_argument('--incremental', help='The posts only cover new periods: compare them with --state and add their columns to the existing outputs',action='store_true')
+    parser.add_argument('--profile', help='Report the time, rows and peak memory of each stage of the run to a .json or .csv file, or print it with no file', nargs='?', const='-', metavar='FILE')
+    parser.add_argument('--trace-memory', help='With --profile, also trace the peak memory allocated in each stage with tracemalloc (slower)', action='store_true')
+    args = parser.parse_args()
+
+    if not (args.posts or args.folder or args.s3):
+        parser.error('one of -p/--posts, -f/--folder or --s3 is needed')
+    if args.incremental and not args.state:
+        parser.error('--incremental needs --state')
+    if args.incremental and args.out_plm:
+        parser.error('--out-plm needs the full history and cannot be run with --incremental')
+    if args.incremental and (args.out_cohort or args.out_cohort_groupby):
+        parser.error('--out-cohort and --out-cohort-groupby need the full history and cannot be run with --incremental')
+    if args.cohort_periods is not None and args.cohort_periods<1:
+        parser.error('--cohort-periods must be at least 1')
+    if (args.start_date or args.end_date) and not args.s3:
+        parser.error('--start-date and --end-date need --s3')
+    if args.s3 and args.cache_dir:
+        parser.error('--cache-dir only caches local post files and cannot be used with --s3')
+    if args.trace_memory and not args.profile:
+        parser.error('--trace-memory needs --profile')
+
+    #day range of the S3 partitions to read
+    try:
+        start_date=datetime.strptime(args.start_date, '%Y-%m-%d').date() if args.start_date else None
+        end_date=datetime.strptime(args.end_date, '%Y-%m-%d').date() if args.end_date else None
+    except ValueError:
+        parser.error('--start-date and --end-date expect dates as YYYY-MM-DD')
+
+    try:
+        zoneinfo.ZoneInfo(args.timezone)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        parser.error(f'unknown timezone {args.timezone}, expected a name such as US/Eastern or Europe/Paris')
+
+    #set the timeframes (month, quarter, half-year, year) -- the posts are loaded once for all of them
+    timeframes=list(TIMEFRAMES) if args.timeframe=='all' else args.timeframe.split(",")
+    for timeframe in timeframes:
+        if timeframe not in TIMEFRAMES:
+            parser.error(f'unknown timeframe {timeframe}, expected month|quarter|half-year|year')
+
+    outputs=[output for output, path in [('all', args.out_all), ('groupby', args.out_groupby), ('plm', args.out_plm),
+                                                  ('cohort', args.out_cohort), ('cohort_groupby', args.out_cohort_groupby), ('state', args.state)] if path]
+
+    try:
+        engine=RetentionEngine(groupby=args.groupby, brand_list=args.brand_list, brand_group=args.brand_group,
+                               group_fillna=args.group_fillna, sapmena=args.sapmena, plm=bool(args.out_plm),
+                               chunksize=args.chunksize, cache_dir=args.cache_dir, workers=args.workers, s3_workers=args.s3_workers,
+                               start_date=start_date, end_date=end_date, timezone=args.timezone, date_format=args.date_format,
+                               cohort_periods=args.cohort_periods,
+                               profile=bool(args.profile), trace_memory=args.trace_memory)
+        engine.load(args.posts or args.folder or args.s3)
+
+        state=engine.read_state(args.state) if args.incremental else None
+        states=[]
+        for timeframe in timeframes:
+            results=engine.run(timeframe, outputs, state)
+            base=results.get('base')
+
+            if args.out_all:
+                with engine.stage('write', len(results['all'])):
+                    write_output(results['all'], output_path(args.out_all, timeframe, timeframes), [], base, args.incremental)
+
+            if args.out_groupby:
+                with engine.stage('write', len(results['groupby'])):
+                    write_output(results['groupby'], output_path(args.out_groupby, timeframe, timeframes), engine.groupby, base, args.incremental)
+
+            if args.out_plm:
+                with engine.stage('write', len(results['plm'])):
+                    results['plm'].to_csv(output_path(args.out_plm, timeframe, timeframes), index=False, quoting=csv.QUOTE_NONNUMERIC)
+
+            for output, path in [('cohort', args.out_cohort), ('cohort_groupby', args.out_cohort_groupby)]:
+                if path:
+                    with engine.stage('write', len(results[output])):
+                        results[output].to_csv(output_path(path, timeframe, timeframes), index=False, quoting=csv.QUOTE_NONNUMERIC)
+
+            if args.state:
+                states.append(results['state'])
+
+        if args.state:
+            with engine.stage('write', sum(len(state) for state in states)):
+                engine.save_state(states, args.state)
+    except RetentionError as error:
+        sys.exit(str(error))
+
+    if args.profile:
+        write_profile(engine.profile_report(), args.profile)
+
+
+    print("Done!")